@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+# Benchmarks the processing pipeline on synthetic data. For every size it
+# generates gpsbabel-style SkyTraq GPX dumps (one per device) plus the CSV
+# extractWaypoints.pl would make of them, then times each stage in its own
+# process and reports points/s and peak RSS. Results can be saved as JSON
+# to compare commits.
+#
+# Usage: benchmark.py [--sizes 10k,100k,1M,10M] [--devices 2] [--output results.json]
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime, timezone
+
+import gpsDb
+import splitFiles
+import monitorPorts
+import splitCSVIntoSessions
+
+START_TIME = 1752900000  # 2025-07-19T04:40:00Z
+GAP_EVERY = 2000  # average points between gaps
+GAP_SECONDS = 2 * 3600  # average gap length, longer than splitFiles.MAX_GAP_TIME
+STAGES = ('parse_gpx_file', 'split_track_points', 'save_to_csv', 'db_inserts',
+          'split_csv_by_time_gap', 'monitor_ingest')
+
+def parse_size(value):
+    # '10k', '1M', '250000'
+    units = {'k': 1000, 'm': 1000000}
+    value = value.strip().lower()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def synthetic_points(count, seed, gap_every=GAP_EVERY, gap_seconds=GAP_SECONDS):
+    # Random walk at 1 Hz with speed changes and randomly spaced gaps.
+    # Coordinates and elevation stay positive, extractWaypoints.pl only
+    # matches unsigned numbers.
+    rng = random.Random(seed)
+    t = START_TIME + rng.randrange(3600)
+    lat = 44.0 + rng.random()
+    lon = 9.0 + rng.random()
+    ele = 100.0 + rng.random() * 400
+    speed = rng.random() * 10
+    for i in range(count):
+        if i and rng.random() < 1 / gap_every:
+            t += int(rng.expovariate(1 / gap_seconds)) + splitFiles.MAX_GAP_TIME * 60 + 1
+        else:
+            t += 1
+        speed = min(40.0, max(0.0, speed + rng.gauss(0, 0.3)))
+        lat = min(89.0, max(0.5, lat + rng.gauss(0, 1e-5) * speed))
+        lon = min(179.0, max(0.5, lon + rng.gauss(0, 1e-5) * speed))
+        ele = max(1.0, ele + rng.gauss(0, 0.5))
+        yield t, lat, lon, ele, speed, i + 1
+
+def write_gpx(path, points):
+    # Same layout as gpsbabel's GPX 1.0 output of a SkyTraq logger
+    now = datetime.now(timezone.utc)
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx version="1.0" creator="GPSBabel - https://www.gpsbabel.org" '
+                'xmlns="http://www.topografix.com/GPX/1/0">\n'
+                f'  <time>{now:%Y-%m-%dT%H:%M:%S}.{now.microsecond // 1000:03d}Z</time>\n'
+                '  <trk>\n    <trkseg>\n')
+        f.writelines(f'      <trkpt lat="{lat:.9f}" lon="{lon:.9f}">\n'
+                     f'        <ele>{ele:.6f}</ele>\n'
+                     f'        <time>{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))}</time>\n'
+                     f'        <speed>{speed:.6f}</speed>\n'
+                     f'        <name>TP{n:04d}</name>\n'
+                     '      </trkpt>\n' for t, lat, lon, ele, speed, n in points)
+        f.write('    </trkseg>\n  </trk>\n</gpx>\n')
+
+def write_csv(path, points):
+    # extractWaypoints.pl format 0
+    with open(path, 'w') as f:
+        f.write("Time,Latitude,Longitude,Name,Elevation,Speed\n")
+        f.writelines(f'{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))},{lat:.9f},{lon:.9f},'
+                     f'TP{n:04d},{ele:.6f},{speed:.6f}\n' for t, lat, lon, ele, speed, n in points)
+
+def generate_fleet(workdir, total_points, devices, seed, gap_every, gap_seconds):
+    # One GPX and one CSV per device, the points split evenly
+    files = []
+    for device in range(devices):
+        count = total_points // devices + (device < total_points % devices)
+        name = f"gps{device + 1:02d}_190000"
+        gpx_path = os.path.join(workdir, 'Downloads', name + '.gpx')
+        csv_path = os.path.join(workdir, name + '.csv')
+        write_gpx(gpx_path, synthetic_points(count, seed + device, gap_every, gap_seconds))
+        write_csv(csv_path, synthetic_points(count, seed + device, gap_every, gap_seconds))
+        files.append((name + '.gpx', gpx_path, csv_path, count))
+    return files
+
+def configure(workdir):
+    # Point the modules at the benchmark directory
+    os.environ['HOME'] = workdir
+    splitFiles.OUTPUT_DIR = os.path.join(workdir, 'Downloads', 'processed')
+    splitFiles.PARSE_CACHE_DIR = os.path.join(workdir, 'Downloads', 'cache')
+    splitFiles.SQLITE_DB = monitorPorts.SQLITE_DB = os.path.join(workdir, 'gps_data.db')
+    monitorPorts.DESTINATION_CATALOG = os.path.join(workdir, 'archive')
+    os.makedirs(splitFiles.OUTPUT_DIR, exist_ok=True)
+    os.makedirs(monitorPorts.DESTINATION_CATALOG, exist_ok=True)
+
+def quiet():
+    sys.stdout = open(os.devnull, 'w')
+
+def stage_parse(files, workdir):
+    return sum(len(chunk) for _, path, _, _ in files for chunk in splitFiles.parse_gpx_file(path))
+
+def stage_split(files, workdir):
+    return sum(len(segment) for _, path, _, _ in files
+               for segment in splitFiles.split_track_points(splitFiles.parse_gpx_file(path)))
+
+def stage_save(files, workdir):
+    # splitFiles.save_to_csv alone: each segment is parsed and split before
+    # its write is timed, so only the writes are counted
+    points = 0
+    seconds = 0.0
+    for filename, path, _, _ in files:
+        segments = splitFiles.split_track_points(splitFiles.parse_gpx_file(path))
+        for i, segment in enumerate(segments, start=1):
+            csv_path = os.path.join(splitFiles.OUTPUT_DIR, f"{filename}.{i:03d}.csv")
+            start = time.perf_counter()
+            stats = splitFiles.save_to_csv(segment, csv_path)
+            seconds += time.perf_counter() - start
+            points += stats['count']
+    return points, seconds
+
+def stage_db(files, workdir):
+    # Registers the files and inserts one row per segment, as the
+    # processing run does
+    conn = gpsDb.get_connection(splitFiles.SQLITE_DB)
+    points = 0
+    for filename, path, _, _ in files:
+        file_id = gpsDb.add_file(conn, filename, filename, 'benchmark')
+        rows = []
+        for i, segment in enumerate(splitFiles.split_track_points(splitFiles.parse_gpx_file(path)), 1):
+            rows.append(splitFiles.segment_row(file_id, f"{filename}.{i:03d}.csv", segment.stats()))
+            points += len(segment)
+        gpsDb.save_file_segments(conn, file_id, rows, 1)
+    return points
+
+def stage_sessions(files, workdir):
+    os.chdir(os.path.join(workdir, 'sessions'))
+    for _, _, csv_path, _ in files:
+        splitCSVIntoSessions.split_csv_by_time_gap(csv_path, splitFiles.MAX_GAP_TIME * 60)
+    return sum(count for *_, count in files)
+
+def stage_ingest(files, workdir):
+    # The monitor's download path fed from a file: drop the header time,
+    # hash, archive copy and inline split
+    for filename, path, _, _ in files:
+        monitorPorts.process_gpx_download(path, filename.split('_')[0])
+    return sum(count for *_, count in files)
+
+STAGE_FUNCTIONS = {
+    'parse_gpx_file': stage_parse,
+    'split_track_points': stage_split,
+    'save_to_csv': stage_save,
+    'db_inserts': stage_db,
+    'split_csv_by_time_gap': stage_sessions,
+    'monitor_ingest': stage_ingest,
+}
+
+def run_stage(stage, files, workdir, queue):
+    # Child process, so peak RSS is per stage
+    configure(workdir)
+    os.makedirs(os.path.join(workdir, 'sessions'), exist_ok=True)
+    quiet()
+    start = time.perf_counter()
+    points = STAGE_FUNCTIONS[stage](files, workdir)
+    seconds = time.perf_counter() - start
+    if isinstance(points, tuple):
+        # The stage timed its own part
+        points, seconds = points
+    queue.put((points, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def time_stage(stage, files, workdir):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run_stage, args=(stage, files, workdir, queue))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError(f"Stage {stage} failed (exit code {proc.exitcode})")
+    points, seconds, peak_rss_kb = queue.get()
+    return {'stage': stage, 'points': points, 'seconds': round(seconds, 4),
+            'points_per_s': round(points / seconds) if seconds else None,
+            'peak_rss_kb': peak_rss_kb}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_benchmark(sizes, devices, stages, seed=1, gap_every=GAP_EVERY, gap_seconds=GAP_SECONDS, keep=False):
+    results = []
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix='gps-benchmark-')
+        try:
+            os.makedirs(os.path.join(workdir, 'Downloads'))
+            start = time.perf_counter()
+            files = generate_fleet(workdir, size, devices, seed, gap_every, gap_seconds)
+            print(f"{size} points, {devices} devices: generated in {time.perf_counter() - start:.1f}s")
+            for stage in stages:
+                result = time_stage(stage, files, workdir)
+                result['size'] = size
+                result['devices'] = devices
+                results.append(result)
+                print(f"  {stage:<22} {result['seconds']:>9.3f}s {result['points_per_s'] or 0:>12,} points/s "
+                      f"{result['peak_rss_kb'] / 1024:>8.1f} MB")
+        finally:
+            if keep:
+                print(f"  data kept in {workdir}")
+            else:
+                shutil.rmtree(workdir)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the GPS processing pipeline')
+    parser.add_argument('--sizes', default='10k,100k',
+                        help='comma separated point counts, e.g. 10k,100k,1M,10M (default 10k,100k)')
+    parser.add_argument('--devices', type=int, default=2, help='devices (files) per size (default 2)')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help=f'comma separated stages (default all: {",".join(STAGES)})')
+    parser.add_argument('--gap-every', type=int, default=GAP_EVERY,
+                        help=f'average points between gaps (default {GAP_EVERY})')
+    parser.add_argument('--gap-seconds', type=int, default=GAP_SECONDS,
+                        help=f'average gap length in seconds (default {GAP_SECONDS})')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', '-o', help='write the results to this JSON file')
+    parser.add_argument('--keep', action='store_true', help='keep the generated data')
+    args = parser.parse_args()
+
+    stages = [s for s in args.stages.split(',') if s]
+    unknown = [s for s in stages if s not in STAGE_FUNCTIONS]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+    results = run_benchmark([parse_size(s) for s in args.sizes.split(',')], args.devices, stages,
+                            args.seed, args.gap_every, args.gap_seconds, args.keep)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(),
+                       'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                       'python': sys.version.split()[0],
+                       'cpus': os.cpu_count(),
+                       'results': results}, f, indent=2)
+        print(f"Results saved to {args.output}")
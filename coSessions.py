@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+# Groups track segments of different devices that overlap in time (and
+# with --spatial also in bounding box), i.e. loggers carried together.
+# The first run sweeps all segments by start time with a heap of the
+# active ones, O(n log n) plus the overlapping pairs. The groups are kept
+# in segment_groups, and later runs only place the new segments, each
+# with an R-tree query for the segments overlapping it.
+#
+# Usage: coSessions.py [--spatial] [--from 2025-07-01] [--to 2025-07-31]
+#                      [--min-devices 2] [--rebuild]
+
+import sys
+import heapq
+import argparse
+import gpsDb
+from gpsLayout import device_name
+
+SQLITE_DB = 'gps_data.db'
+WORLD = (-90.0, -180.0, 90.0, 180.0)
+
+def boxes_overlap(a, b):
+    # Segment rows as from gpsDb.ungrouped_segments
+    return a[5] >= b[4] and b[5] >= a[4] and a[7] >= b[6] and b[7] >= a[6]
+
+def sweep_groups(segments, devices, spatial=False):
+    # segments sorted by start time; returns segment id -> group id (the
+    # smallest segment id of its group)
+    parent = {}
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    active = []  # (end_s, id, segment) of the segments not ended yet
+    for segment in segments:
+        segment_id, gpx_id, start_s, end_s = segment[:4]
+        parent[segment_id] = segment_id
+        while active and active[0][0] < start_s:
+            heapq.heappop(active)
+        for _, other_id, other in active:
+            if devices[other[1]] == devices[gpx_id] or (spatial and not boxes_overlap(segment, other)):
+                continue
+            a, b = find(segment_id), find(other_id)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        heapq.heappush(active, (end_s, segment_id, segment))
+    return {segment_id: find(segment_id) for segment_id in parent}
+
+def place_segment(conn, segment, devices, spatial):
+    # Adds one new segment to the groups of the other devices' segments
+    # overlapping it, merging those groups
+    segment_id, gpx_id, start_s, end_s, min_lat, max_lat, min_lon, max_lon = segment
+    area = (min_lat, min_lon, max_lat, max_lon) if spatial else WORLD
+    others = [row[0] for row in gpsDb.query_segments(conn, *area, start_s, end_s)
+              if row[0] != segment_id and row[1] in devices and devices[row[1]] != devices[gpx_id]]
+    groups = set(gpsDb.segment_group_ids(conn, others, spatial).values())
+    target = min(groups | {segment_id})
+    gpsDb.merge_segment_groups(conn, groups, target, spatial)
+    gpsDb.set_segment_groups(conn, [(segment_id, target)], spatial)
+
+def update_groups(conn, spatial=False, rebuild=False):
+    # Brings segment_groups up to date, returns the number of segments placed
+    devices = {file_id: device_name(filename) for file_id, filename in gpsDb.file_names(conn).items()}
+    with conn:
+        if rebuild:
+            gpsDb.clear_segment_groups(conn, spatial)
+        segments = gpsDb.ungrouped_segments(conn, spatial)
+        if not segments:
+            return 0
+        if not gpsDb.has_segment_groups(conn, spatial):
+            groups = sweep_groups(segments, devices, spatial)
+            gpsDb.set_segment_groups(conn, groups.items(), spatial)
+        else:
+            for segment in segments:
+                place_segment(conn, segment, devices, spatial)
+    return len(segments)
+
+def co_sessions(conn, spatial=False, start_s=None, end_s=None, min_devices=2):
+    # Generator of (group id, [(device, segment row), ...]) for the groups
+    # with segments of at least min_devices devices
+    devices = {file_id: device_name(filename) for file_id, filename in gpsDb.file_names(conn).items()}
+    group_id, members = None, []
+    for row in gpsDb.grouped_segments(conn, spatial, start_s, end_s) + [(None,)]:
+        if row[0] != group_id:
+            if len({device for device, _ in members}) >= min_devices:
+                yield group_id, members
+            group_id, members = row[0], []
+        if row[0] is not None:
+            members.append((devices.get(row[2], '?'), row))
+
+if __name__ == "__main__":
+    from querySegments import parse_bound
+    parser = argparse.ArgumentParser(description="List segments of different devices recorded together")
+    parser.add_argument('--spatial', action='store_true',
+                        help="segment bounding boxes must overlap too, not only the time spans")
+    parser.add_argument('--from', dest='start', help="start date or timestamp (UTC)")
+    parser.add_argument('--to', dest='end', help="end date or timestamp (UTC)")
+    parser.add_argument('--min-devices', type=int, default=2,
+                        help="devices a group needs to be listed (default 2)")
+    parser.add_argument('--rebuild', action='store_true', help="regroup all segments from scratch")
+    parser.add_argument('--db', default=SQLITE_DB, help="database file")
+    args = parser.parse_args()
+    try:
+        start_s = parse_bound(args.start)
+        end_s = parse_bound(args.end, end_of_day=True)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    conn = gpsDb.get_connection(args.db)
+    placed = update_groups(conn, args.spatial, args.rebuild)
+    if placed:
+        print(f"Grouped {placed} new segments", file=sys.stderr)
+    groups = [(min(row[4] for _, row in members), max(row[5] for _, row in members), members)
+              for _, members in co_sessions(conn, args.spatial, start_s, end_s, args.min_devices)]
+    count = 0
+    for start_time, end_time, members in sorted(groups, key=lambda group: group[:2]):
+        devices = sorted({device for device, _ in members})
+        print(f"{start_time} - {end_time}\t{len(devices)} devices: {', '.join(devices)}")
+        for device, (_, _, _, filename, seg_start, seg_end) in members:
+            print(f"  {device}\t{filename}\t{seg_start}\t{seg_end}")
+        count += 1
+    print(f"{count} co-sessions found", file=sys.stderr)
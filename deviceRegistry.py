@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+# Serial number -> logger name, read from the mapping files once and kept
+# in a dict. Every lookup only stats the files and reads them again when
+# one has changed, so a docking device costs the same with 20 loggers as
+# with 2000 and edits to the files are picked up without a restart.
+# Both files have "<serial> <name>" lines; names are written 'GPS#05' or
+# 'gps05' and are all turned into the second form.
+#
+# Usage: deviceRegistry.py [--db gps_data.db]
+
+import os
+import re
+import sys
+import argparse
+from threading import Lock
+import gpsDb
+
+SQLITE_DB = 'gps_data.db'
+REGISTRY_FILES = ['serial2name.txt', 'serial_device_mapping.txt']  # the first file listing a serial wins
+
+# A by-id name like usb-STMicroelectronics_STM32_Virtual_COM_Port_0A7831533334-if00,
+# else any run of exactly 12 hex digits
+BY_ID_SERIAL = re.compile(r'_([0-9A-Fa-f]{12})-(?:if|port)\d+$')
+ANY_SERIAL = re.compile(r'(?<![0-9A-Fa-f])([0-9A-Fa-f]{12})(?![0-9A-Fa-f])')
+
+def extract_serial(device_name):
+    # Serial number (upper case) in a /dev/serial/by-id name, or None
+    match = BY_ID_SERIAL.search(device_name) or ANY_SERIAL.search(device_name)
+    return match.group(1).upper() if match else None
+
+def canonical_name(name):
+    # 'GPS#05' -> 'gps05'
+    return name.replace('#', '').lower()
+
+class DeviceRegistry:
+    def __init__(self, paths=None):
+        self.paths = list(paths or REGISTRY_FILES)
+        self.signature = None  # (mtime_ns, size) of each file at the last load
+        self.names = {}  # serial -> name
+        self.serials = {}  # name -> serial
+        self.lock = Lock()
+
+    def file_signature(self):
+        signature = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                signature.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def refresh(self):
+        # Reads the files again if any changed since the last load
+        signature = self.file_signature()
+        if signature == self.signature:
+            return
+        with self.lock:
+            if signature == self.signature:
+                return
+            names = {}
+            for path, stat in zip(self.paths, signature):
+                if stat is None:
+                    continue
+                with open(path) as f:
+                    for line in f:
+                        parts = line.split()
+                        if len(parts) < 2 or parts[0].startswith('#'):
+                            continue
+                        serial, name = parts[0].upper(), canonical_name(parts[1])
+                        if names.setdefault(serial, name) != name:
+                            print(f"Warning: {serial} is {names[serial]}, ignoring {name} in {path}")
+            if not any(signature):
+                print(f"Warning: none of {', '.join(self.paths)} found")
+            self.names = names
+            self.serials = {}
+            for serial, name in names.items():
+                self.serials.setdefault(name, serial)
+            self.signature = signature
+
+    def name_of(self, serial):
+        self.refresh()
+        return self.names.get(serial.upper()) if serial else None
+
+    def serial_of(self, name):
+        # Serial of a device given by name in either form
+        self.refresh()
+        return self.serials.get(canonical_name(name))
+
+    def devices(self):
+        # serial -> name of all known devices
+        self.refresh()
+        return dict(self.names)
+
+_registry = DeviceRegistry()
+
+def name_of(serial):
+    return _registry.name_of(serial)
+
+def serial_of(name):
+    return _registry.serial_of(name)
+
+def devices():
+    return _registry.devices()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the known loggers and their last downloads")
+    parser.add_argument('--db', default=SQLITE_DB, help="database file")
+    args = parser.parse_args()
+
+    states = gpsDb.device_states(gpsDb.get_connection(args.db))
+    known = devices()
+    for serial in sorted(set(known) | set(states), key=lambda serial: (known.get(serial, '~'), serial)):
+        _, last_seen, last_download, seconds, bytes_in, baud = states.get(serial, (None,) * 6)
+        download = f"{last_download} {bytes_in} bytes in {seconds:.1f}s" if last_download else '-'
+        print(f"{serial}\t{known.get(serial, '?')}\tseen {last_seen or '-'}\tdownload {download}"
+              f"\tbaud {baud or '-'}")
+    print(f"{len(known)} devices in {', '.join(_registry.paths)}", file=sys.stderr)
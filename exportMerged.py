@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+# Exports the points of all devices in a time window as one CSV in time
+# order, with a device column. Only the segments whose span overlaps the
+# window are opened (found through gpx_segments), each one when the merge
+# reaches its start time, and their points are merged with a heap, so
+# memory grows with the number of segments open at once, not with the
+# number of points.
+#
+# Usage: exportMerged.py --from 2025-07-19 [--to 2025-07-19T18:00:00Z]
+#                        [--device gps05 ...] [--output day.csv[.gz]]
+
+import os
+import csv
+import sys
+import heapq
+import argparse
+import gpsDb
+import gpsSegment
+import gpsCompress
+import splitFiles
+from gpsLayout import device_name
+from deviceRegistry import canonical_name
+from gpsTime import epoch_ms
+from querySegments import SQLITE_DB, parse_bound
+
+WORLD = (-90.0, -180.0, 90.0, 180.0)
+HEADER = ['device', 'latitude', 'longitude', 'elevation', 'timestamp', 'speed', 'name']
+
+def segment_points(path, start_ms, end_ms):
+    # Generator of (epoch ms, row) for the points of a segment file inside
+    # [start_ms, end_ms], rows in the segment CSV's column order
+    if path.endswith(gpsSegment.EXTENSION):
+        with gpsSegment.SegmentFile(path) as seg:
+            offsets, blob = seg.name_offsets, seg.name_blob
+            for i, t in enumerate(seg.time):
+                if t < start_ms:
+                    continue
+                if t > end_ms:
+                    return
+                ele, speed = seg.ele[i], seg.speed[i]
+                name = bytes(blob[offsets[i]:offsets[i + 1]]).decode('utf-8')
+                yield t, [seg.lat[i], seg.lon[i], ele if ele == ele else '', seg.time_string(i),
+                          speed if speed == speed else '', name]
+        return
+    with gpsCompress.open_file(path, 'rt', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            t = epoch_ms(row[3]) if len(row) > 3 else None
+            if t is None or t < start_ms:
+                continue
+            if t > end_ms:
+                return
+            yield t, row
+
+def merge_segments(segments, start_ms, end_ms):
+    # k-way merge of (start ms, device, path) segments into (device, row)
+    # in time order; a segment is opened only once the merge gets to its
+    # start, ties go to the segment that started first
+    segments = sorted(segments)
+    heap = []
+    opened = 0
+    while heap or opened < len(segments):
+        while opened < len(segments) and (not heap or segments[opened][0] <= heap[0][0]):
+            _, device, path = segments[opened]
+            points = segment_points(path, start_ms, end_ms)
+            first = next(points, None)
+            if first is not None:
+                heapq.heappush(heap, (first[0], opened, device, first[1], points))
+            opened += 1
+        if not heap:
+            continue
+        _, order, device, row, points = heap[0]
+        yield device, row
+        following = next(points, None)
+        if following is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (following[0], order, device, following[1], points))
+
+def window_segments(conn, start_s, end_s, devices=None):
+    # (start ms, device, path) of the segment files overlapping the window
+    files = gpsDb.file_names(conn)
+    for _, gpx_id, filename, start_time, *_ in gpsDb.query_segments(conn, *WORLD, start_s, end_s):
+        device = device_name(files.get(gpx_id, ''))
+        if devices and device not in devices:
+            continue
+        path = os.path.join(splitFiles.OUTPUT_DIR, filename)
+        if not os.path.exists(path):
+            print(f"Warning: {path} not found", file=sys.stderr)
+            continue
+        yield epoch_ms(start_time), device, path
+
+def export(out, start_s, end_s, devices=None, db_path=SQLITE_DB):
+    # Writes the merged CSV to out, returns the number of points
+    start_ms = start_s * 1000
+    end_ms = end_s * 1000 + 999
+    segments = list(window_segments(gpsDb.get_connection(db_path), start_s, end_s, devices))
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(HEADER)
+    count = 0
+    for device, row in merge_segments(segments, start_ms, end_ms):
+        writer.writerow([device] + row)
+        count += 1
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export all devices' points in a time window, merged by time")
+    parser.add_argument('--from', dest='start', required=True, help="start date or timestamp (UTC)")
+    parser.add_argument('--to', dest='end', help="end date or timestamp (UTC), default the end of the start day")
+    parser.add_argument('--device', action='append', help="only this device (repeatable)")
+    parser.add_argument('--output', '-o', help="output file (.gz/.xz compressed), default stdout")
+    parser.add_argument('--db', default=SQLITE_DB, help="database file")
+    args = parser.parse_args()
+    try:
+        start_s = parse_bound(args.start)
+        end_s = parse_bound(args.end or args.start[:10], end_of_day=True)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    devices = [canonical_name(device) for device in args.device or []]
+    if args.output:
+        with gpsCompress.open_file(args.output, 'wt', newline='') as out:
+            count = export(out, start_s, end_s, devices, args.db)
+    else:
+        count = export(sys.stdout, start_s, end_s, devices, args.db)
+    print(f"{count} points exported", file=sys.stderr)
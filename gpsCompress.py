@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+# Optional gzip/lzma storage for the archived GPX dumps and the segment
+# CSVs. Compressed files get a '.gz' or '.xz' suffix after their normal
+# name (gps05_190000.gpx.gz) and are read back through streaming
+# decompression, so no reader needs the whole file in memory.
+
+import os
+import gzip
+import lzma
+
+COMPRESSIONS = (None, 'gzip', 'lzma')
+EXTENSIONS = {'gzip': '.gz', 'lzma': '.xz'}
+GZIP_LEVEL = 6  # gzip's own default, 9 costs a lot more CPU for little gain
+LZMA_PRESET = 6
+
+def compression_of(path):
+    # Compression of a file by its name, None for plain files
+    for compression, extension in EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+def add_extension(path, compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    return path + EXTENSIONS[compression] if compression else path
+
+def strip_extension(path):
+    # The name without a compression suffix
+    compression = compression_of(path)
+    return path[:-len(EXTENSIONS[compression])] if compression else path
+
+def open_file(path, mode='rb', compression=None, **kwargs):
+    # open() that compresses or decompresses on the fly. The compression
+    # comes from the name unless given (for '.part' files); kwargs go to
+    # the text layer (newline, encoding).
+    compression = compression or compression_of(path)
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL, **kwargs)
+    if compression == 'lzma':
+        return lzma.open(path, mode, preset=LZMA_PRESET if 'r' not in mode else None, **kwargs)
+    if compression is not None:
+        raise ValueError(f"Unknown compression: {compression}")
+    return open(path, mode, **kwargs)
+
+def writer(raw, compression):
+    # Compressing writer on an open binary file. Closing it finishes the
+    # stream but leaves raw open (so it can still be fsynced); without
+    # compression raw itself is returned.
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=GZIP_LEVEL)
+    if compression == 'lzma':
+        return lzma.LZMAFile(raw, 'wb', preset=LZMA_PRESET)
+    if compression is not None:
+        raise ValueError(f"Unknown compression: {compression}")
+    return raw
+
+def existing_variants(path):
+    # The plain and compressed files present for a plain path
+    return [variant for variant in (add_extension(path, c) for c in COMPRESSIONS)
+            if os.path.exists(variant)]
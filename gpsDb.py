@@ -0,0 +1,465 @@
+#!/usr/bin/python3
+
+# Shared SQLite access for monitorPorts.py and splitFiles.py. One
+# long-lived connection per database file, WAL so the monitor can insert
+# while a processing run reads, a busy timeout instead of "database is
+# locked" errors, and numbered schema migrations.
+
+import sqlite3
+from threading import Lock
+
+SQLITE_DB = 'gps_data.db'
+BUSY_TIMEOUT = 30  # seconds to wait for a lock held by another process
+
+# Each entry moves the schema one version up (PRAGMA user_version)
+MIGRATIONS = [
+    '''CREATE TABLE IF NOT EXISTS gps_files
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT UNIQUE,
+            md5_hash TEXT UNIQUE,
+            timestamp TEXT,
+            processingState INTEGER DEFAULT 0);
+       CREATE TABLE IF NOT EXISTS gpx_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            gpx_id INTEGER,
+            filename TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            record_count INTEGER,
+            min_lat REAL,
+            max_lat REAL,
+            min_lon REAL,
+            max_lon REAL,
+            FOREIGN KEY(gpx_id) REFERENCES gps_files(id));''',
+    '''CREATE INDEX IF NOT EXISTS idx_gps_files_state ON gps_files(processingState);
+       CREATE INDEX IF NOT EXISTS idx_gpx_segments_gpx_id ON gpx_segments(gpx_id);
+       CREATE INDEX IF NOT EXISTS idx_gpx_segments_time ON gpx_segments(start_time, end_time);''',
+    '''CREATE TABLE IF NOT EXISTS device_watermarks (
+            serial TEXT PRIMARY KEY,
+            last_time TEXT,
+            last_time_ms INTEGER,
+            tail_hash TEXT,
+            updated TEXT);''',
+    '''ALTER TABLE device_watermarks ADD COLUMN last_sector INTEGER;''',
+    # R-tree over segment bounding boxes and time spans (epoch seconds),
+    # kept in sync with gpx_segments by triggers
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS gpx_segments_rtree USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon, start_s, end_s);
+       INSERT INTO gpx_segments_rtree
+            SELECT id, min_lat, max_lat, min_lon, max_lon,
+                   CAST(strftime('%s', start_time) AS INTEGER),
+                   CAST(strftime('%s', end_time) AS INTEGER)
+            FROM gpx_segments WHERE min_lat IS NOT NULL AND start_time IS NOT NULL;
+       CREATE TRIGGER IF NOT EXISTS gpx_segments_rtree_insert AFTER INSERT ON gpx_segments
+       WHEN new.min_lat IS NOT NULL AND new.start_time IS NOT NULL BEGIN
+            INSERT INTO gpx_segments_rtree VALUES (
+                new.id, new.min_lat, new.max_lat, new.min_lon, new.max_lon,
+                CAST(strftime('%s', new.start_time) AS INTEGER),
+                CAST(strftime('%s', new.end_time) AS INTEGER));
+       END;
+       CREATE TRIGGER IF NOT EXISTS gpx_segments_rtree_update AFTER UPDATE ON gpx_segments BEGIN
+            DELETE FROM gpx_segments_rtree WHERE id=old.id;
+            INSERT INTO gpx_segments_rtree SELECT
+                new.id, new.min_lat, new.max_lat, new.min_lon, new.max_lon,
+                CAST(strftime('%s', new.start_time) AS INTEGER),
+                CAST(strftime('%s', new.end_time) AS INTEGER)
+            WHERE new.min_lat IS NOT NULL AND new.start_time IS NOT NULL;
+       END;
+       CREATE TRIGGER IF NOT EXISTS gpx_segments_rtree_delete AFTER DELETE ON gpx_segments BEGIN
+            DELETE FROM gpx_segments_rtree WHERE id=old.id;
+       END;''',
+    # Gap threshold (minutes) a segment was split with, NULL if unknown
+    '''ALTER TABLE gpx_segments ADD COLUMN max_gap INTEGER;''',
+    # Motion metrics (gpsTrack.Track.motion), NULL for segments split
+    # before they existed until they are resegmented
+    '''ALTER TABLE gpx_segments ADD COLUMN distance REAL;         -- metres
+       ALTER TABLE gpx_segments ADD COLUMN moving_time REAL;      -- seconds
+       ALTER TABLE gpx_segments ADD COLUMN max_speed REAL;        -- m/s
+       ALTER TABLE gpx_segments ADD COLUMN avg_speed REAL;        -- m/s while moving
+       ALTER TABLE gpx_segments ADD COLUMN elevation_gain REAL;   -- metres''',
+    # Groups of segments from different devices that overlap in time
+    # (spatial=1: and in bounding box), maintained by coSessions.py. A
+    # deleted segment ungroups its whole group for re-evaluation.
+    '''CREATE TABLE IF NOT EXISTS segment_groups
+           (segment_id INTEGER NOT NULL,
+            spatial INTEGER NOT NULL,
+            group_id INTEGER NOT NULL,  -- smallest segment id in the group
+            PRIMARY KEY (segment_id, spatial));
+       CREATE INDEX IF NOT EXISTS idx_segment_groups_group ON segment_groups(spatial, group_id);
+       CREATE TRIGGER IF NOT EXISTS segment_groups_delete AFTER DELETE ON gpx_segments BEGIN
+            DELETE FROM segment_groups WHERE (spatial, group_id) IN
+                (SELECT spatial, group_id FROM segment_groups WHERE segment_id=old.id);
+       END;''',
+    # Position of a segment in its file (the .NNN in its name), unique per
+    # file so a file processed again updates its rows instead of adding
+    # duplicates. Duplicates left by interrupted runs are dropped first.
+    # (A correlated count rather than UPDATE ... FROM, which needs SQLite 3.33.)
+    '''DELETE FROM gpx_segments WHERE id NOT IN
+            (SELECT MIN(id) FROM gpx_segments GROUP BY gpx_id, filename);
+       ALTER TABLE gpx_segments ADD COLUMN segment_index INTEGER;
+       UPDATE gpx_segments SET segment_index =
+            (SELECT COUNT(*) FROM gpx_segments s
+             WHERE s.gpx_id IS gpx_segments.gpx_id AND s.id <= gpx_segments.id);
+       CREATE UNIQUE INDEX IF NOT EXISTS idx_gpx_segments_file_index
+            ON gpx_segments(gpx_id, segment_index);
+       CREATE TRIGGER IF NOT EXISTS segment_groups_update AFTER UPDATE ON gpx_segments
+       WHEN old.start_time IS NOT new.start_time OR old.end_time IS NOT new.end_time
+            OR old.min_lat IS NOT new.min_lat OR old.max_lat IS NOT new.max_lat
+            OR old.min_lon IS NOT new.min_lon OR old.max_lon IS NOT new.max_lon BEGIN
+            DELETE FROM segment_groups WHERE (spatial, group_id) IN
+                (SELECT spatial, group_id FROM segment_groups WHERE segment_id=old.id);
+       END;''',
+    # Points and dwell time per map tile (gpsTiles), per file in file_tiles
+    # and summed per tile and device in tiles, which the triggers keep in
+    # step. Dwell is in integer milliseconds so subtracting a file's tiles
+    # again leaves no rounding behind.
+    '''CREATE TABLE IF NOT EXISTS file_tiles
+           (gpx_id INTEGER NOT NULL,
+            zoom INTEGER NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            device TEXT NOT NULL,
+            points INTEGER NOT NULL,
+            dwell_ms INTEGER NOT NULL,
+            PRIMARY KEY (gpx_id, zoom, x, y)) WITHOUT ROWID;
+       CREATE TABLE IF NOT EXISTS tiles
+           (zoom INTEGER NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            device TEXT NOT NULL,
+            points INTEGER NOT NULL,
+            dwell_ms INTEGER NOT NULL,
+            files INTEGER NOT NULL,
+            PRIMARY KEY (zoom, x, y, device)) WITHOUT ROWID;
+       CREATE TRIGGER IF NOT EXISTS file_tiles_insert AFTER INSERT ON file_tiles BEGIN
+            INSERT INTO tiles VALUES (new.zoom, new.x, new.y, new.device, new.points, new.dwell_ms, 1)
+            ON CONFLICT(zoom, x, y, device) DO UPDATE SET
+                points=points + excluded.points, dwell_ms=dwell_ms + excluded.dwell_ms, files=files + 1;
+       END;
+       CREATE TRIGGER IF NOT EXISTS file_tiles_delete AFTER DELETE ON file_tiles BEGIN
+            UPDATE tiles SET points=points - old.points, dwell_ms=dwell_ms - old.dwell_ms, files=files - 1
+                WHERE zoom=old.zoom AND x=old.x AND y=old.y AND device=old.device;
+            DELETE FROM tiles WHERE zoom=old.zoom AND x=old.x AND y=old.y AND device=old.device
+                AND files <= 0;
+       END;''',
+    # Runtime state per logger (deviceRegistry): when it was last docked,
+    # its last download, and the baud rate the native download got
+    '''CREATE TABLE IF NOT EXISTS device_state (
+            serial TEXT PRIMARY KEY,
+            name TEXT,
+            last_seen TEXT,
+            last_download TEXT,
+            last_download_seconds REAL,
+            last_download_bytes INTEGER,
+            preferred_baud INTEGER);''',
+]
+
+_connections = {}
+_connections_lock = Lock()
+
+def get_connection(db_path=None):
+    # The connection is shared by all threads of the process, callers that
+    # write from several threads serialize through their own lock
+    db_path = db_path or SQLITE_DB
+    with _connections_lock:
+        conn = _connections.get(db_path)
+        if conn is None:
+            conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT * 1000}')
+            migrate(conn)
+            _connections[db_path] = conn
+        return conn
+
+def close_connection(db_path=None):
+    with _connections_lock:
+        conn = _connections.pop(db_path or SQLITE_DB, None)
+        if conn is not None:
+            conn.close()
+
+def script_statements(script):
+    # The statements of a migration one by one (a ';' inside a trigger
+    # body doesn't end one)
+    statement = ''
+    for part in script.split(';'):
+        statement += part + ';'
+        if sqlite3.complete_statement(statement):
+            if statement.strip(' \n;'):
+                yield statement
+            statement = ''
+
+def migrate(conn):
+    # Each migration runs with its user_version bump in one IMMEDIATE
+    # transaction, the version read again once the write lock is held, so
+    # a failing statement leaves nothing half applied and the monitor and
+    # splitFiles.py starting together don't both run the same migration.
+    # (executescript would commit every statement on its own.)
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            number = conn.execute('PRAGMA user_version').fetchone()[0]
+            if number >= len(MIGRATIONS):
+                conn.rollback()
+                return
+            for statement in script_statements(MIGRATIONS[number]):
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version={number + 1}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+def file_exists(conn, md5_hash):
+    return conn.execute("SELECT 1 FROM gps_files WHERE md5_hash=?", (md5_hash,)).fetchone() is not None
+
+def filename_exists(conn, filename):
+    return conn.execute("SELECT 1 FROM gps_files WHERE filename=?", (filename,)).fetchone() is not None
+
+def add_file(conn, filename, md5_hash, timestamp):
+    with conn:
+        cur = conn.execute("INSERT INTO gps_files (filename, md5_hash, timestamp) VALUES (?, ?, ?)",
+                           (filename, md5_hash, timestamp))
+    return cur.lastrowid
+
+def pending_files(conn):
+    return conn.execute("SELECT id, filename, md5_hash FROM gps_files WHERE processingState=0 "
+                        "ORDER BY id").fetchall()
+
+def file_info(conn, file_id):
+    # (processingState, md5_hash) or None
+    return conn.execute("SELECT processingState, md5_hash FROM gps_files WHERE id=?", (file_id,)).fetchone()
+
+def files_to_resegment(conn, max_gap):
+    # Processed files with segments split with another (or unknown) gap,
+    # without motion metrics or without tiles
+    return conn.execute('''SELECT DISTINCT f.id, f.filename, f.md5_hash FROM gps_files f
+                           JOIN gpx_segments s ON s.gpx_id = f.id
+                           WHERE f.processingState=1
+                             AND (s.max_gap IS NULL OR s.max_gap != ? OR s.distance IS NULL
+                                  OR NOT EXISTS (SELECT 1 FROM file_tiles t WHERE t.gpx_id = f.id))
+                           ORDER BY f.id''', (max_gap,)).fetchall()
+
+# Rows as made by splitFiles.segment_row, plus the segment index. A row
+# that is already there (same file and index) is updated in place.
+SEGMENT_UPSERT = '''INSERT INTO gpx_segments
+                    (gpx_id, filename, start_time, end_time, record_count,
+                     min_lat, max_lat, min_lon, max_lon, max_gap,
+                     distance, moving_time, max_speed, avg_speed, elevation_gain, segment_index)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(gpx_id, segment_index) DO UPDATE SET
+                        filename=excluded.filename, start_time=excluded.start_time,
+                        end_time=excluded.end_time, record_count=excluded.record_count,
+                        min_lat=excluded.min_lat, max_lat=excluded.max_lat,
+                        min_lon=excluded.min_lon, max_lon=excluded.max_lon, max_gap=excluded.max_gap,
+                        distance=excluded.distance, moving_time=excluded.moving_time,
+                        max_speed=excluded.max_speed, avg_speed=excluded.avg_speed,
+                        elevation_gain=excluded.elevation_gain'''
+
+def store_segments(conn, file_id, segment_rows):
+    # Makes a file's rows exactly segment_rows (segment i gets index i),
+    # inside the caller's transaction
+    conn.executemany(SEGMENT_UPSERT, ((*row, i) for i, row in enumerate(segment_rows, start=1)))
+    conn.execute("DELETE FROM gpx_segments WHERE gpx_id=? AND segment_index>?", (file_id, len(segment_rows)))
+
+def store_tiles(conn, file_id, tile_rows):
+    # Makes a file's tiles exactly tile_rows (gpsTiles.TileCounter.rows),
+    # inside the caller's transaction; the triggers move the sums in tiles
+    conn.execute("DELETE FROM file_tiles WHERE gpx_id=?", (file_id,))
+    conn.executemany("INSERT INTO file_tiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     ((file_id, *row) for row in tile_rows))
+
+def save_file_segments(conn, file_id, segment_rows, state, tile_rows=None):
+    # All segment rows (and tiles, if counted) of a file and its new state
+    # in one transaction. Idempotent: storing a file again replaces its
+    # rows. A failed file (state 2) keeps whatever rows it had.
+    with conn:
+        if state == 1:
+            store_segments(conn, file_id, segment_rows)
+            if tile_rows is not None:
+                store_tiles(conn, file_id, tile_rows)
+        conn.execute("UPDATE gps_files SET processingState=? WHERE id=?", (state, file_id))
+
+def save_downloaded_file(conn, filename, md5_hash, timestamp, segment_rows=None, tile_rows=None,
+                         watermark=None):
+    # A download split while it arrived, all in one transaction: its
+    # gps_files row, its segment rows (made with file id None) and tiles
+    # with state 1, and the device's watermark ((serial, last_time,
+    # last_time_ms, tail_hash) as for set_watermark). segment_rows None
+    # leaves the file pending. Returns the file id.
+    with conn:
+        file_id = conn.execute("INSERT INTO gps_files (filename, md5_hash, timestamp) VALUES (?, ?, ?)",
+                               (filename, md5_hash, timestamp)).lastrowid
+        if segment_rows is not None:
+            store_segments(conn, file_id, [(file_id, *row[1:]) for row in segment_rows])
+            if tile_rows is not None:
+                store_tiles(conn, file_id, tile_rows)
+            conn.execute("UPDATE gps_files SET processingState=1 WHERE id=?", (file_id,))
+        if watermark:
+            store_watermark(conn, *watermark)
+    return file_id
+
+def replace_file_segments(conn, file_id, segment_rows, tile_rows=None):
+    # Swaps a file's segment rows (and tiles) in one transaction, returns
+    # the old segment file names
+    with conn:
+        old = [row[0] for row in conn.execute("SELECT filename FROM gpx_segments WHERE gpx_id=?", (file_id,))]
+        store_segments(conn, file_id, segment_rows)
+        if tile_rows is not None:
+            store_tiles(conn, file_id, tile_rows)
+    return old
+
+def query_tiles(conn, zoom, min_x, min_y, max_x, max_y):
+    # (x, y, device, points, dwell_ms) of the tiles in the tile range
+    return conn.execute('''SELECT x, y, device, points, dwell_ms FROM tiles
+                           WHERE zoom=? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?''',
+                        (zoom, min_x, max_x, min_y, max_y)).fetchall()
+
+def query_segments(conn, min_lat, min_lon, max_lat, max_lon, start_s=None, end_s=None):
+    # Segments whose bounding box overlaps the area and whose time span
+    # overlaps [start_s, end_s]. The R-tree stores 32 bit floats rounded
+    # outwards, so its hits are re-checked against the exact columns.
+    start_s = -1e12 if start_s is None else start_s
+    end_s = 1e12 if end_s is None else end_s
+    return conn.execute('''SELECT s.id, s.gpx_id, s.filename, s.start_time, s.end_time, s.record_count,
+                                  s.min_lat, s.max_lat, s.min_lon, s.max_lon
+                           FROM gpx_segments_rtree r JOIN gpx_segments s ON s.id = r.id
+                           WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+                             AND r.end_s >= ? AND r.start_s <= ?
+                             AND s.max_lat >= ? AND s.min_lat <= ? AND s.max_lon >= ? AND s.min_lon <= ?
+                             AND CAST(strftime('%s', s.end_time) AS INTEGER) >= ?
+                             AND CAST(strftime('%s', s.start_time) AS INTEGER) <= ?
+                           ORDER BY s.start_time''',
+                        (min_lat, max_lat, min_lon, max_lon, start_s, end_s) * 2).fetchall()
+
+def file_names(conn):
+    # gps_files id -> filename
+    return dict(conn.execute("SELECT id, filename FROM gps_files"))
+
+def ungrouped_segments(conn, spatial):
+    # Segments not in segment_groups yet as (id, gpx_id, start_s, end_s,
+    # min_lat, max_lat, min_lon, max_lon), by start time. Segments whose
+    # gps_files row is gone (old databases cleaned up by hand) have no
+    # device and are left out.
+    return conn.execute('''SELECT s.id, s.gpx_id,
+                                  CAST(strftime('%s', s.start_time) AS INTEGER),
+                                  CAST(strftime('%s', s.end_time) AS INTEGER),
+                                  s.min_lat, s.max_lat, s.min_lon, s.max_lon
+                           FROM gpx_segments s
+                           JOIN gps_files f ON f.id = s.gpx_id
+                           LEFT JOIN segment_groups g ON g.segment_id = s.id AND g.spatial = ?
+                           WHERE g.segment_id IS NULL AND s.start_time IS NOT NULL
+                             AND s.min_lat IS NOT NULL
+                           ORDER BY 3, s.id''', (int(spatial),)).fetchall()
+
+def has_segment_groups(conn, spatial):
+    return conn.execute("SELECT 1 FROM segment_groups WHERE spatial=? LIMIT 1",
+                        (int(spatial),)).fetchone() is not None
+
+def clear_segment_groups(conn, spatial):
+    conn.execute("DELETE FROM segment_groups WHERE spatial=?", (int(spatial),))
+
+def segment_group_ids(conn, segment_ids, spatial):
+    # segment id -> group id for the grouped ones among segment_ids
+    groups = {}
+    segment_ids = list(segment_ids)
+    for i in range(0, len(segment_ids), 500):
+        part = segment_ids[i:i + 500]
+        groups.update(conn.execute(f'''SELECT segment_id, group_id FROM segment_groups
+                                       WHERE spatial=? AND segment_id IN ({','.join('?' * len(part))})''',
+                                   (int(spatial), *part)))
+    return groups
+
+def set_segment_groups(conn, rows, spatial):
+    # rows of (segment_id, group_id)
+    conn.executemany("INSERT OR REPLACE INTO segment_groups (segment_id, spatial, group_id) VALUES (?, ?, ?)",
+                     ((segment_id, int(spatial), group_id) for segment_id, group_id in rows))
+
+def merge_segment_groups(conn, group_ids, target, spatial):
+    # Moves every segment of group_ids into group target
+    group_ids = [group_id for group_id in group_ids if group_id != target]
+    if group_ids:
+        conn.execute(f'''UPDATE segment_groups SET group_id=?
+                         WHERE spatial=? AND group_id IN ({','.join('?' * len(group_ids))})''',
+                     (target, int(spatial), *group_ids))
+
+def grouped_segments(conn, spatial, start_s=None, end_s=None):
+    # Segments of the groups with more than one member whose span
+    # overlaps [start_s, end_s], by group and start time
+    start_s = -1e12 if start_s is None else start_s
+    end_s = 1e12 if end_s is None else end_s
+    return conn.execute('''SELECT g.group_id, s.id, s.gpx_id, s.filename, s.start_time, s.end_time
+                           FROM segment_groups g JOIN gpx_segments s ON s.id = g.segment_id
+                           WHERE g.spatial = ? AND g.group_id IN
+                               (SELECT g2.group_id FROM segment_groups g2
+                                JOIN gpx_segments s2 ON s2.id = g2.segment_id
+                                WHERE g2.spatial = ?
+                                GROUP BY g2.group_id HAVING COUNT(*) > 1
+                                   AND MAX(CAST(strftime('%s', s2.end_time) AS INTEGER)) >= ?
+                                   AND MIN(CAST(strftime('%s', s2.start_time) AS INTEGER)) <= ?)
+                           ORDER BY g.group_id, s.start_time, s.id''',
+                        (int(spatial), int(spatial), start_s, end_s)).fetchall()
+
+def get_watermark(conn, serial):
+    # (last_time_ms, tail_hash) of the newest archived point of a device
+    return conn.execute("SELECT last_time_ms, tail_hash FROM device_watermarks WHERE serial=?",
+                        (serial,)).fetchone()
+
+def store_watermark(conn, serial, last_time, last_time_ms, tail_hash):
+    # Inside the caller's transaction
+    conn.execute('''INSERT INTO device_watermarks (serial, last_time, last_time_ms, tail_hash, updated)
+                    VALUES (?, ?, ?, ?, datetime('now'))
+                    ON CONFLICT(serial) DO UPDATE SET
+                        last_time=excluded.last_time, last_time_ms=excluded.last_time_ms,
+                        tail_hash=excluded.tail_hash, updated=excluded.updated''',
+                 (serial, last_time, last_time_ms, tail_hash))
+
+def set_watermark(conn, serial, last_time, last_time_ms, tail_hash):
+    with conn:
+        store_watermark(conn, serial, last_time, last_time_ms, tail_hash)
+
+def get_last_sector(conn, serial):
+    # Log sector being written at the last native download, or None
+    row = conn.execute("SELECT last_sector FROM device_watermarks WHERE serial=?", (serial,)).fetchone()
+    return row[0] if row else None
+
+def set_last_sector(conn, serial, sector):
+    with conn:
+        conn.execute('''INSERT INTO device_watermarks (serial, last_sector, updated)
+                        VALUES (?, ?, datetime('now'))
+                        ON CONFLICT(serial) DO UPDATE SET
+                            last_sector=excluded.last_sector, updated=excluded.updated''',
+                     (serial, sector))
+
+def get_device_state(conn, serial):
+    # (name, last_seen, last_download, seconds, bytes, preferred_baud) or None
+    return conn.execute('''SELECT name, last_seen, last_download, last_download_seconds,
+                                  last_download_bytes, preferred_baud
+                           FROM device_state WHERE serial=?''', (serial,)).fetchone()
+
+def device_states(conn):
+    # serial -> the get_device_state row
+    return {row[0]: row[1:] for row in conn.execute('''SELECT serial, name, last_seen, last_download,
+                                                           last_download_seconds, last_download_bytes,
+                                                           preferred_baud FROM device_state''')}
+
+def set_device_seen(conn, serial, name):
+    with conn:
+        conn.execute('''INSERT INTO device_state (serial, name, last_seen) VALUES (?, ?, datetime('now'))
+                        ON CONFLICT(serial) DO UPDATE SET name=excluded.name, last_seen=excluded.last_seen''',
+                     (serial, name))
+
+def set_device_download(conn, serial, seconds, bytes_in, baud=None):
+    # A finished download; baud None (gpsbabel) keeps the preferred rate
+    with conn:
+        conn.execute('''INSERT INTO device_state (serial, last_download, last_download_seconds,
+                                                  last_download_bytes, preferred_baud)
+                        VALUES (?, datetime('now'), ?, ?, ?)
+                        ON CONFLICT(serial) DO UPDATE SET
+                            last_download=excluded.last_download,
+                            last_download_seconds=excluded.last_download_seconds,
+                            last_download_bytes=excluded.last_download_bytes,
+                            preferred_baud=COALESCE(excluded.preferred_baud, preferred_baud)''',
+                     (serial, seconds, bytes_in, baud))
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+
+# Partitioned storage layout for the archived dumps and the segment files:
+# <root>/<device>/<year>/<month>/ instead of one flat directory, each
+# partition with a manifest.jsonl that lists its files (path relative to
+# the root, size, md5 of the stored bytes, plus what the writer adds).
+# Entries are only appended; a later entry for the same path replaces the
+# earlier one and {"path": ..., "removed": true} drops it. Tools read the
+# manifests instead of listing the partitions.
+#
+# Usage: gpsLayout.py ROOT [--device gps05] [--month 2025-07] [--rebuild]
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+from gpsTime import utc_datetime
+from deviceRegistry import canonical_name
+
+LAYOUTS = ('flat', 'partitioned')
+MANIFEST = 'manifest.jsonl'
+
+def device_name(filename):
+    # 'gps05/2025/07/gps05_20250719_205140.gpx' or 'gps05_190000.gpx' -> 'gps05',
+    # also for archives named before the names were unified ('GPS05_190000.gpx')
+    return canonical_name(os.path.basename(filename).split('_')[0])
+
+def partition(device, ms):
+    # Partition directory (relative to the root) for a device and a time
+    dt = utc_datetime(ms)
+    return os.path.join(device, f"{dt:%Y}", f"{dt:%m}")
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def append_entry(root, entry):
+    # One line per write() on an O_APPEND file, so the monitor and a
+    # processing run can add to the same manifest
+    line = json.dumps(entry, sort_keys=True) + '\n'
+    with open(os.path.join(root, os.path.dirname(entry['path']), MANIFEST), 'a') as f:
+        f.write(line)
+
+def record(root, path, **fields):
+    # Adds the file at root/path (just written) to its partition's manifest
+    full_path = os.path.join(root, path)
+    append_entry(root, {'path': path, 'size': os.path.getsize(full_path), 'md5': file_md5(full_path),
+                        'recorded': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), **fields})
+
+def record_removed(root, path):
+    if os.path.dirname(path) and os.path.isdir(os.path.join(root, os.path.dirname(path))):
+        append_entry(root, {'path': path, 'removed': True})
+
+def read_manifest(manifest_path):
+    # path -> entry, later entries winning
+    entries = {}
+    with open(manifest_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Line cut short by a crash
+            if entry.get('removed'):
+                entries.pop(entry['path'], None)
+            else:
+                entries[entry['path']] = entry
+    return entries
+
+def manifests(root, device=None, month=None):
+    # Manifest paths, optionally of one device and/or month ('YYYY-MM')
+    year, month = month.split('-') if month else ('*', '*')
+    return sorted(glob.glob(os.path.join(glob.escape(root), glob.escape(device) if device else '*',
+                                         year, month, MANIFEST)))
+
+def entries(root, device=None, month=None):
+    # Generator over the live entries of the matching partitions
+    for manifest_path in manifests(root, device, month):
+        yield from read_manifest(manifest_path).values()
+
+def rebuild(root):
+    # Writes every partition's manifest again from the files in it (for
+    # trees written before manifests, or edited by hand)
+    count = 0
+    for partition_dir in sorted(glob.glob(os.path.join(glob.escape(root), '*', '[0-9]' * 4, '[0-9]' * 2))):
+        relative = os.path.relpath(partition_dir, root)
+        lines = []
+        for name in sorted(os.listdir(partition_dir)):
+            full_path = os.path.join(partition_dir, name)
+            if name == MANIFEST or name.endswith('.part') or name.startswith('.') or not os.path.isfile(full_path):
+                continue
+            lines.append(json.dumps({'path': os.path.join(relative, name), 'size': os.path.getsize(full_path),
+                                     'md5': file_md5(full_path)}, sort_keys=True) + '\n')
+        tmp_path = os.path.join(partition_dir, f'.{MANIFEST}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, os.path.join(partition_dir, MANIFEST))
+        count += len(lines)
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the files of a partitioned archive from its manifests")
+    parser.add_argument('root', help="archive root, e.g. ~/Downloads/processed")
+    parser.add_argument('--device', help="only this device")
+    parser.add_argument('--month', help="only this month, YYYY-MM")
+    parser.add_argument('--rebuild', action='store_true', help="rewrite the manifests from the files")
+    args = parser.parse_args()
+    root = os.path.expanduser(args.root)
+    if args.rebuild:
+        print(f"{rebuild(root)} files in the manifests", file=sys.stderr)
+        sys.exit(0)
+    count = 0
+    for entry in entries(root, args.device, args.month):
+        print(f"{entry['path']}\t{entry['size']}\t{entry['md5']}")
+        count += 1
+    print(f"{count} files", file=sys.stderr)
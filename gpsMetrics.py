@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+# Runtime metrics for monitorPorts.py and splitFiles.py: stage timers,
+# counters and gauges kept in memory, written out as a Prometheus textfile
+# (node_exporter textfile collector) and/or a JSON snapshot, plus optional
+# JSON-lines event logs and a cProfile hook. Everything is off unless the
+# file names below are set; collecting costs a dict update per call.
+
+import os
+import json
+import time
+import cProfile
+from threading import Lock
+from contextlib import contextmanager
+
+PREFIX = 'gps_'
+TEXTFILE = None  # Prometheus textfile path, e.g. '/var/lib/node_exporter/textfile/gps.prom'
+JSON_FILE = None  # JSON snapshot path
+EVENT_LOG = None  # JSON-lines event log path
+PROFILE_DIR = None  # directory for cProfile dumps of profiled() blocks
+
+_lock = Lock()
+_counters = {}  # (name, labels) -> value
+_gauges = {}  # (name, labels) -> value
+_timers = {}  # (stage, labels) -> [count, total seconds, max seconds]
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def count(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def observe(stage, seconds, **labels):
+    key = _key(stage, labels)
+    with _lock:
+        timer = _timers.get(key)
+        if timer is None:
+            _timers[key] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+@contextmanager
+def timer(stage, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **labels)
+
+class StageClock:
+    # Accumulates the time of many short steps (one per chunk or point
+    # batch) locally and reports each stage once with flush()
+    def __init__(self, **labels):
+        self.labels = labels
+        self.totals = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+
+    def timed_iter(self, name, iterable):
+        # Time spent producing the items of an iterator
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+                return
+            self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+            yield item
+
+    def flush(self):
+        for name, seconds in self.totals.items():
+            observe(name, seconds, **self.labels)
+        self.totals = {}
+
+def drain():
+    # Takes everything collected so far, for sending from a worker process
+    # to the parent, which passes it to merge()
+    global _counters, _gauges, _timers
+    with _lock:
+        data = (_counters, _gauges, _timers)
+        _counters, _gauges, _timers = {}, {}, {}
+    return data
+
+def merge(data):
+    counters, gauges, timers = data
+    with _lock:
+        for key, value in counters.items():
+            _counters[key] = _counters.get(key, 0) + value
+        _gauges.update(gauges)
+        for key, (n, total, longest) in timers.items():
+            timer = _timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += n
+            timer[1] += total
+            timer[2] = max(timer[2], longest)
+
+def log_event(event, **fields):
+    # One JSON object per line, appended to EVENT_LOG
+    if not EVENT_LOG:
+        return
+    line = json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'event': event,
+                       **fields}, default=str)
+    with _lock:
+        with open(EVENT_LOG, 'a') as f:
+            f.write(line + '\n')
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+def prometheus_text():
+    lines = []
+    with _lock:
+        counters, gauges = sorted(_counters.items()), sorted(_gauges.items())
+        timers = sorted((key, list(value)) for key, value in _timers.items())
+    typed = set()
+    for kind, items in (('counter', counters), ('gauge', gauges)):
+        for (name, labels), value in items:
+            if name not in typed:
+                lines.append(f'# TYPE {PREFIX}{name} {kind}')
+                typed.add(name)
+            lines.append(f'{PREFIX}{name}{_labels(labels)} {value}')
+    if timers:
+        lines.append(f'# TYPE {PREFIX}stage_seconds summary')
+        for (stage, labels), (n, total, longest) in timers:
+            stage_labels = _labels((('stage', stage),) + labels)
+            lines.append(f'{PREFIX}stage_seconds_sum{stage_labels} {total:.6f}')
+            lines.append(f'{PREFIX}stage_seconds_count{stage_labels} {n}')
+        lines.append(f'# TYPE {PREFIX}stage_seconds_max gauge')
+        for (stage, labels), (n, total, longest) in timers:
+            lines.append(f'{PREFIX}stage_seconds_max{_labels((("stage", stage),) + labels)} {longest:.6f}')
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    with _lock:
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(_counters.items())],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(_gauges.items())],
+            'timers': [{'stage': stage, 'labels': dict(labels), 'count': n,
+                        'seconds': round(total, 6), 'max_seconds': round(longest, 6)}
+                       for (stage, labels), (n, total, longest) in sorted(_timers.items())],
+        }
+
+def _write_atomic(path, text):
+    # The textfile collector must never see a half written file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def write_snapshot():
+    if TEXTFILE:
+        _write_atomic(TEXTFILE, prometheus_text())
+    if JSON_FILE:
+        _write_atomic(JSON_FILE, json.dumps(snapshot(), indent=2) + '\n')
+
+@contextmanager
+def profiled(name):
+    # cProfile the block into PROFILE_DIR/<name>.prof (read it with pstats)
+    if not PROFILE_DIR:
+        yield
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f'{name}.prof'))
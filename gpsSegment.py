@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+# Binary segment files (.seg), the compact alternative to the segment CSVs.
+# Layout, all little endian:
+#   header   magic 'GPSSEG1\0', version u32, reserved u32, count u64,
+#            name table size u64 (32 bytes)
+#   columns  time int64[count] (epoch ms), lat, lon, ele, speed
+#            float64[count] each (NaN where missing)
+#   names    uint32[count + 1] offsets into the UTF-8 name blob, blob
+#   times    the original time strings, laid out like the names (version
+#            2; version 1 blocks have none and the strings are rebuilt
+#            from the epoch ms, which loses e.g. a '.5Z' fraction)
+# SegmentFile maps a file and exposes the columns as memoryviews into
+# the mapping, so opening one costs no parsing and no copies. A file may
+# hold several such blocks back to back (the splitFiles parse cache).
+
+import os
+import sys
+import mmap
+import struct
+from array import array
+from itertools import accumulate
+from gpsTrack import Track
+from gpsTime import utc_datetime
+
+EXTENSION = '.seg'
+MAGIC = b'GPSSEG1\0'
+VERSION = 2
+VERSIONS = (1, 2)  # versions read
+HEADER = struct.Struct('<8sIIQQ')
+COLUMNS = (('time', 'q'), ('lat', 'd'), ('lon', 'd'), ('ele', 'd'), ('speed', 'd'))
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+def to_little_endian(column, typecode):
+    # Bytes of a column in file order
+    if LITTLE_ENDIAN:
+        return memoryview(column).cast('B')
+    column = array(typecode, column)
+    column.byteswap()
+    return column.tobytes()
+
+def string_table(strings):
+    # (uint32 offsets, UTF-8 blob) of a list of strings
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = array('I', [0])
+    offsets.extend(accumulate(map(len, encoded)))
+    return offsets, b''.join(encoded)
+
+def write_block(f, segment):
+    # One header + columns + names + times block for a Track (or view)
+    name_offsets, name_blob = string_table(segment.name)
+    time_offsets, time_blob = string_table(segment.times)
+
+    f.write(HEADER.pack(MAGIC, VERSION, 0, len(segment), len(name_blob)))
+    for column, typecode in COLUMNS:
+        f.write(to_little_endian(getattr(segment, column), typecode))
+    f.write(to_little_endian(name_offsets, 'I'))
+    f.write(name_blob)
+    f.write(to_little_endian(time_offsets, 'I'))
+    f.write(time_blob)
+
+def save_segment(segment, output_path):
+    # Writes a Track (or view) and returns its stats like save_to_csv
+    with open(output_path, 'wb') as f:
+        write_block(f, segment)
+    return segment.stats()
+
+def format_time(ms):
+    # gpsbabel style UTC timestamp, milliseconds only when present
+    dt = utc_datetime(ms)
+    if ms % 1000:
+        return f"{dt:%Y-%m-%dT%H:%M:%S}.{ms % 1000:03d}Z"
+    return f"{dt:%Y-%m-%dT%H:%M:%S}Z"
+
+def file_version(path):
+    # Version of the first block of a segment file, None if it is none
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    magic, version = HEADER.unpack(header)[:2]
+    return version if magic == MAGIC else None
+
+class SegmentFile:
+    # Read-only view of the block at offset in a .seg file. The columns are
+    # memoryviews into the mapping (copies on big endian hosts) and stay
+    # valid until close(); end is the offset of the next block.
+    def __init__(self, path, offset=0):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, _, self.count, names_size = HEADER.unpack_from(self.map, offset)
+            if magic != MAGIC or version not in VERSIONS:
+                raise ValueError(f"Not a segment file: {path}")
+            self.end = offset + HEADER.size + self.count * 44 + 4 + names_size
+            if version > 1:
+                self.end += (self.count + 1) * 4
+            if len(self.map) < self.end:
+                raise ValueError(f"Truncated segment file: {path}")
+
+            data = memoryview(self.map)
+            self.views = [data]
+            offset += HEADER.size
+            for column, typecode in COLUMNS:
+                setattr(self, column, self.column_view(data, offset, self.count, typecode))
+                offset += self.count * 8
+            self.name_offsets = self.column_view(data, offset, self.count + 1, 'I')
+            offset += (self.count + 1) * 4
+            self.name_blob = data[offset:offset + names_size]
+            self.views.append(self.name_blob)
+            self.time_offsets = self.time_blob = None
+            if version > 1:
+                offset += names_size
+                self.time_offsets = self.column_view(data, offset, self.count + 1, 'I')
+                offset += (self.count + 1) * 4
+                self.end = offset + self.time_offsets[self.count]
+                if len(self.map) < self.end:
+                    raise ValueError(f"Truncated segment file: {path}")
+                self.time_blob = data[offset:self.end]
+                self.views.append(self.time_blob)
+        except Exception:
+            self.close()
+            raise
+
+    def column_view(self, data, offset, count, typecode):
+        size = struct.calcsize(typecode)
+        raw = data[offset:offset + count * size]
+        if not LITTLE_ENDIAN:
+            column = array(typecode)
+            column.frombytes(raw)
+            column.byteswap()
+            return memoryview(column)
+        view = raw.cast(typecode)
+        self.views += [raw, view]
+        return view
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def names(self):
+        offsets = self.name_offsets
+        blob = bytes(self.name_blob)
+        return [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(self.count)]
+
+    def time_strings(self):
+        # The time strings as written, rebuilt from the ms in version 1 files
+        if self.time_blob is None:
+            return [format_time(ms) for ms in self.time]
+        offsets = self.time_offsets
+        blob = bytes(self.time_blob)
+        return [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(self.count)]
+
+    def time_string(self, i):
+        if self.time_blob is None:
+            return format_time(self.time[i])
+        return bytes(self.time_blob[self.time_offsets[i]:self.time_offsets[i + 1]]).decode('utf-8')
+
+    def numpy(self, column):
+        # The column as a NumPy array sharing the mapping
+        import numpy
+        return numpy.frombuffer(getattr(self, column), dtype=getattr(self, column).format)
+
+    def track(self):
+        # Track over the mapped columns; the time strings and names are
+        # decoded here, the numeric columns are not copied
+        track = Track.__new__(Track)
+        for column, _ in COLUMNS:
+            setattr(track, column, getattr(self, column))
+        track.times = self.time_strings()
+        track.name = [sys.intern(name) for name in self.names()]
+        return track
+
+    def close(self):
+        for view in reversed(getattr(self, 'views', [])):
+            view.release()
+        self.views = []
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+def load_segment(path):
+    # Track with its own copy of the data, independent of the file
+    with SegmentFile(path) as seg:
+        mapped = seg.track()
+        track = Track()
+        track.extend(mapped)
+    return track
+
+def read_tracks(path):
+    # Generator: a copied Track per block of a multi-block file
+    size = os.path.getsize(path)
+    offset = 0
+    while offset < size:
+        with SegmentFile(path, offset) as block:
+            track = Track()
+            track.extend(block.track())
+            offset = block.end
+        yield track
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: gpsSegment.py <file.seg>")
+        sys.exit(1)
+    with SegmentFile(sys.argv[1]) as seg:
+        track = seg.track()
+        print("latitude,longitude,elevation,timestamp,speed,name")
+        for lat, lon, ele, time, speed, name in zip(track.lat, track.lon, track.ele, track.times,
+                                                   track.speed, track.name):
+            print(f'{lat},{lon},{ele if ele == ele else ""},{time},'
+                  f'{speed if speed == speed else ""},"{name}"')
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+# Point counts and dwell time per slippy-map tile (the z/x/y of web map
+# tiles) at a few zoom levels, for coverage heatmaps without reading the
+# segment files. splitFiles.py and monitorPorts.py count the tiles of each
+# file while its segments are written and store them with the segments;
+# the tiles table holds the sums per tile and device (gpsDb keeps it up to
+# date when a file's tiles are stored again).
+#
+# Usage: gpsTiles.py --bbox 44.0,9.5,45.0,10.5 --zoom 12 [--device gps05]
+
+import sys
+import math
+import argparse
+import operator
+from array import array
+from itertools import compress, islice, repeat
+import gpsDb
+import querySegments
+from deviceRegistry import canonical_name
+
+SQLITE_DB = 'gps_data.db'
+TILE_ZOOMS = (4, 8, 12, 16)  # zoom levels stored, 16 is about 600 m at 0 degrees latitude
+MAX_LAT = 85.05112878  # the web map square ends here
+
+def tile_xy(lat, lon, zoom):
+    # Tile of one point
+    n = 1 << zoom
+    lat = min(max(lat, -MAX_LAT), MAX_LAT)
+    x = int(lon * (n / 360.0) + n / 2.0)
+    y = int(n / 2.0 - math.asinh(math.tan(lat * (math.pi / 180))) * (n / 2.0 / math.pi))
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tile_columns(lat, lon, zoom):
+    # tile_xy over whole columns, each step a C level map; the clamping is
+    # only done for columns that reach the edges of the map
+    mul, n = operator.mul, 1 << zoom
+    if min(lat) < -MAX_LAT or max(lat) > MAX_LAT:
+        lat = array('d', map(min, map(max, lat, repeat(-MAX_LAT)), repeat(MAX_LAT)))
+    x = array('q', map(int, map(operator.add, map(mul, lon, repeat(n / 360.0)), repeat(n / 2.0))))
+    y = array('q', map(int, map(operator.sub, repeat(n / 2.0), map(mul, map(math.asinh, map(math.tan, map(
+        mul, lat, repeat(math.pi / 180)))), repeat(n / 2.0 / math.pi)))))
+    if min(x) < 0 or max(x) >= n:
+        x = array('q', map(min, map(max, x, repeat(0)), repeat(n - 1)))
+    if min(y) < 0 or max(y) >= n:
+        y = array('q', map(min, map(max, y, repeat(0)), repeat(n - 1)))
+    return x, y
+
+class TileCounter:
+    # Points and dwell (ms until the next point of the same segment) per
+    # tile and zoom level, summed over the segments added
+    def __init__(self, zooms=TILE_ZOOMS):
+        self.zooms = sorted(zooms)
+        self.counts = {}  # (zoom, x, y) -> [points, dwell_ms]
+
+    def add(self, track):
+        if not len(track):
+            return
+        # Tiles at the finest zoom, the coarser ones are shifts of these
+        top = self.zooms[-1]
+        xs, ys = tile_columns(track.lat, track.lon, top)
+        keys = array('q', map(operator.or_, map(operator.lshift, xs, repeat(32)), ys))
+        # Runs of points in the same tile, only the runs are visited in Python
+        last = len(keys) - 1
+        starts = [0] + list(compress(range(1, len(keys)), map(operator.ne, islice(keys, 1, None), keys)))
+        ends = starts[1:] + [last + 1]
+        t = track.time
+        runs = {}
+        for key, points, dwell_ms in zip(map(keys.__getitem__, starts), map(operator.sub, ends, starts),
+                                         map(operator.sub, map(t.__getitem__, ends[:-1] + [last]),
+                                             map(t.__getitem__, starts))):
+            run = runs.get(key)
+            if run is None:
+                runs[key] = [points, dwell_ms]
+            else:
+                run[0] += points
+                run[1] += dwell_ms
+        counts = self.counts
+        for key, (points, dwell_ms) in runs.items():
+            x, y = key >> 32, key & 0xffffffff
+            for zoom in self.zooms:
+                shift = top - zoom
+                count = counts.setdefault((zoom, x >> shift, y >> shift), [0, 0])
+                count[0] += points
+                count[1] += dwell_ms
+
+    def rows(self, device):
+        # (zoom, x, y, device, points, dwell_ms) as gpsDb.store_tiles takes them
+        return [(zoom, x, y, device, points, dwell_ms)
+                for (zoom, x, y), (points, dwell_ms) in sorted(self.counts.items())]
+
+def stored_zoom(zoom):
+    # The stored zoom level to answer a request for zoom with
+    return max((z for z in TILE_ZOOMS if z <= zoom), default=TILE_ZOOMS[0])
+
+def viewport(conn, min_lat, min_lon, max_lat, max_lon, zoom, devices=None):
+    # (zoom used, [(x, y, points, dwell_s, devices), ...]) for the tiles
+    # covering the area, from the tiles table only
+    zoom = stored_zoom(zoom)
+    min_x, min_y = tile_xy(max_lat, min_lon, zoom)  # y grows southwards
+    max_x, max_y = tile_xy(min_lat, max_lon, zoom)
+    tiles = {}
+    for x, y, device, points, dwell_ms in gpsDb.query_tiles(conn, zoom, min_x, min_y, max_x, max_y):
+        if devices and device not in devices:
+            continue
+        tile = tiles.setdefault((x, y), [0, 0, []])
+        tile[0] += points
+        tile[1] += dwell_ms
+        tile[2].append(device)
+    return zoom, [(x, y, points, dwell_ms / 1000, names)
+                  for (x, y), (points, dwell_ms, names) in sorted(tiles.items())]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Point counts and dwell time per map tile in an area")
+    parser.add_argument('--bbox', type=querySegments.parse_bbox, default=(-MAX_LAT, -180.0, MAX_LAT, 180.0),
+                        help="min_lat,min_lon,max_lat,max_lon (default the whole map)")
+    parser.add_argument('--zoom', type=int, default=TILE_ZOOMS[0],
+                        help=f"zoom level, answered from the nearest stored one of {TILE_ZOOMS}")
+    parser.add_argument('--device', action='append', help="only this device (repeatable)")
+    parser.add_argument('--db', default=SQLITE_DB, help="database file")
+    args = parser.parse_args()
+
+    devices = [canonical_name(device) for device in args.device or []]
+    zoom, tiles = viewport(gpsDb.get_connection(args.db), *args.bbox, args.zoom, devices)
+    for x, y, points, dwell_s, devices in tiles:
+        print(f"{zoom}/{x}/{y}\t{points}\t{dwell_s:.0f}\t{','.join(devices)}")
+    print(f"{len(tiles)} tiles at zoom {zoom}", file=sys.stderr)
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+# Shared timestamp decoding for the GPS scripts. gpsbabel and the CSV
+# exports always use 'YYYY-MM-DDTHH:MM:SS[.fff]Z', so the fields are read
+# by fixed offsets instead of strptime, and the date part is converted
+# once per distinct day.
+
+from array import array
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+
+_day_cache = {}
+
+def day_ms(date_str):
+    # 'YYYY-MM-DD' -> epoch milliseconds of that midnight (UTC)
+    ms = _day_cache.get(date_str)
+    if ms is None:
+        if date_str[4] != '-' or date_str[7] != '-':
+            raise ValueError(f"Bad date: {date_str}")
+        day = datetime(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10]))
+        ms = (day - EPOCH).days * 86400000
+        _day_cache[date_str] = ms
+    return ms
+
+def epoch_ms(time_str):
+    # Integer epoch milliseconds, or None if the string is not in the
+    # expected layout
+    try:
+        if time_str[10] != 'T' or time_str[13] != ':' or time_str[16] != ':' or time_str[-1] != 'Z':
+            return None
+        ms = day_ms(time_str[:10]) + (int(time_str[11:13]) * 3600 +
+                                     int(time_str[14:16]) * 60 +
+                                     int(time_str[17:19])) * 1000
+        if len(time_str) > 20:
+            if time_str[19] != '.':
+                return None
+            ms += int((time_str[20:-1] + '00')[:3])
+        return ms
+    except (ValueError, IndexError):
+        return None
+
+def epoch_seconds(time_str):
+    # Integer epoch seconds (fractions dropped), or None
+    ms = epoch_ms(time_str)
+    return None if ms is None else ms // 1000
+
+def epoch_ms_column(time_strs):
+    # Batch version for a whole column; returns array('q') and raises
+    # ValueError on the first unreadable value
+    column = array('q')
+    append = column.append
+    for time_str in time_strs:
+        ms = epoch_ms(time_str)
+        if ms is None:
+            raise ValueError(f"Bad timestamp: {time_str!r}")
+        append(ms)
+    return column
+
+def epoch_seconds_column(time_strs):
+    return array('q', [ms // 1000 for ms in epoch_ms_column(time_strs)])
+
+def utc_datetime(ms):
+    # Naive UTC datetime for filename formatting
+    return EPOCH + timedelta(milliseconds=ms)
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+# Columnar track storage. A Track keeps one array per field instead of one
+# dict per point, so a segment costs a few bytes per point and the
+# per-segment statistics are single passes over flat arrays.
+
+import sys
+import math
+import operator
+from array import array
+from itertools import compress, islice, repeat
+from gpsTime import epoch_ms
+
+NO_VALUE = float('nan')  # ele/speed not present in the source
+EARTH_RADIUS = 6371008.8  # metres, mean radius
+MOVING_SPEED = 0.5  # m/s, slower steps between points count as standing still
+
+def raw(column):
+    # Byte view of an array or memoryview column
+    return memoryview(column).cast('B')
+
+class Track:
+    __slots__ = ('time', 'times', 'lat', 'lon', 'ele', 'speed', 'name')
+
+    def __init__(self):
+        self.time = array('q')   # epoch milliseconds
+        self.times = []          # original time strings, written back unchanged
+        self.lat = array('d')
+        self.lon = array('d')
+        self.ele = array('d')    # NO_VALUE where missing
+        self.speed = array('d')  # NO_VALUE where missing
+        self.name = []           # interned point names
+
+    def __len__(self):
+        return len(self.time)
+
+    def append(self, time_str, lat, lon, ele=NO_VALUE, speed=NO_VALUE, name=''):
+        t = epoch_ms(time_str)
+        if t is None:
+            return False
+        self.time.append(t)
+        self.times.append(time_str)
+        self.lat.append(lat)
+        self.lon.append(lon)
+        self.ele.append(ele)
+        self.speed.append(speed)
+        self.name.append(sys.intern(name))
+        return True
+
+    def view(self, start, end):
+        # Zero-copy slice: the numeric columns are memoryviews into this
+        # track's arrays
+        part = Track.__new__(Track)
+        part.time = memoryview(self.time)[start:end]
+        part.times = self.times[start:end]
+        part.lat = memoryview(self.lat)[start:end]
+        part.lon = memoryview(self.lon)[start:end]
+        part.ele = memoryview(self.ele)[start:end]
+        part.speed = memoryview(self.speed)[start:end]
+        part.name = self.name[start:end]
+        return part
+
+    def extend(self, other):
+        # Appends another track (or view) with a memcpy per column
+        self.time.frombytes(raw(other.time))
+        self.times.extend(other.times)
+        self.lat.frombytes(raw(other.lat))
+        self.lon.frombytes(raw(other.lon))
+        self.ele.frombytes(raw(other.ele))
+        self.speed.frombytes(raw(other.speed))
+        self.name.extend(other.name)
+
+    def gap_indices(self, max_gap_ms):
+        # Indexes i where time[i] - time[i-1] exceeds the gap; the
+        # differences and the threshold test run as chained C iterators
+        t = self.time
+        steps = map(operator.sub, islice(t, 1, None), t)
+        return list(compress(range(1, len(t)), map(operator.lt, repeat(max_gap_ms), steps)))
+
+    def split(self, max_gap_ms):
+        # Views of the runs between gaps
+        cuts = [0] + self.gap_indices(max_gap_ms) + [len(self)]
+        return [self.view(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+    def step_distances(self):
+        # Haversine distance in metres from each point to the next, every
+        # step a C level map over the whole columns
+        mul, sub = operator.mul, operator.sub
+        half_rad = math.pi / 360  # degrees to radians, halved
+        lat, lon = self.lat, self.lon
+        half_dlat = array('d', map(math.sin, map(mul, map(sub, islice(lat, 1, None), lat), repeat(half_rad))))
+        half_dlon = array('d', map(math.sin, map(mul, map(sub, islice(lon, 1, None), lon), repeat(half_rad))))
+        cos_lat = array('d', map(math.cos, map(mul, lat, repeat(2 * half_rad))))
+        a = array('d', map(operator.add, map(mul, half_dlat, half_dlat),
+                           map(mul, map(mul, cos_lat, islice(cos_lat, 1, None)), map(mul, half_dlon, half_dlon))))
+        try:
+            angles = array('d', map(math.asin, map(math.sqrt, a)))
+        except ValueError:
+            # Rounding can take a just past 1 for antipodal (broken) points
+            angles = array('d', map(math.asin, map(math.sqrt, map(min, a, repeat(1.0)))))
+        return array('d', map(mul, angles, repeat(2 * EARTH_RADIUS)))
+
+    def motion(self, moving_speed=MOVING_SPEED):
+        # Distance (m), moving time (s), max and average moving speed (m/s,
+        # over the moving steps only) and elevation gain (m). Max speed is
+        # the logger's own speed where it recorded one, else the fastest step.
+        mul, sub = operator.mul, operator.sub
+        t = self.time
+        distances = self.step_distances()
+        steps_ms = array('q', map(sub, islice(t, 1, None), t))
+        # distance / time >= moving_speed, without dividing by zero steps
+        moving = list(map(operator.ge, map(mul, distances, repeat(1000.0)),
+                          map(mul, steps_ms, repeat(moving_speed))))
+        distance = math.fsum(distances)
+        moving_s = sum(compress(steps_ms, moving)) / 1000
+        # Jitter while standing still adds distance but no moving time
+        moving_distance = math.fsum(compress(distances, moving))
+        
+        speed = self.speed
+        max_speed = max(compress(speed, map(operator.eq, speed, speed)), default=None)
+        if max_speed is None:
+            timed = list(map(operator.lt, repeat(0), steps_ms))
+            max_speed = max(map(operator.truediv, map(mul, compress(distances, timed), repeat(1000.0)),
+                                compress(steps_ms, timed)), default=None)
+        
+        ele = self.ele
+        ele = array('d', compress(ele, map(operator.eq, ele, ele)))
+        gain = math.fsum(filter((0.0).__lt__, map(sub, islice(ele, 1, None), ele)))
+        return {
+            'distance': distance,
+            'moving_time': moving_s,
+            'max_speed': max_speed,
+            'avg_speed': moving_distance / moving_s if moving_s else None,
+            'elevation_gain': gain
+        }
+
+    def stats(self):
+        return {
+            'count': len(self),
+            'start_time': self.times[0],
+            'end_time': self.times[-1],
+            'min_lat': min(self.lat),
+            'max_lat': max(self.lat),
+            'min_lon': min(self.lon),
+            'max_lon': max(self.lon),
+            **self.motion()
+        }
@@ -2,204 +2,704 @@
 
 
 import os
-import re
 import time
+import errno
+import shutil
 import hashlib
-import sqlite3
-from datetime import datetime
+import queue
+import signal
+import tempfile
 import subprocess
-from threading import Thread
+from collections import deque
+from threading import Thread, Lock, Timer
+from concurrent.futures import ThreadPoolExecutor
+from serialWatcher import create_watcher
+from gpsTime import epoch_ms, utc_datetime
+import gpsDb
+import gpsMetrics
+import gpsCompress
+import gpsLayout
+import gpsTiles
+import coSessions
+import deviceRegistry
+import skytraq
+import splitFiles
 
 # Configuration
-SERIAL2NAME_FILE = 'serial2name.txt'
-GPX_FILE = '/tmp/last.gpx'
 SQLITE_DB = 'gps_data.db'
 DESTINATION_CATALOG = os.path.expanduser('~/Downloads')
-PROCESS_DATA_SCRIPT = 'doThings.sh'
-CHECK_INTERVAL = 5  # seconds between checks
+ARCHIVE_LAYOUT = 'flat'  # 'flat', or 'partitioned': <device>/<year>/<month>/<device>_<date>_<time>.gpx
+ARCHIVE_COMPRESSION = None  # None, 'gzip' or 'lzma' for the archived dumps (md5 is over the plain GPX)
+SERIAL_BY_ID_DIR = '/dev/serial/by-id'  # directory watched for new devices
+WATCH_BACKEND = 'auto'  # 'inotify', 'poll' or 'auto' (inotify, else polling)
+CHECK_INTERVAL = 5  # seconds between checks when polling
+MAX_PARALLEL_DOWNLOADS = 4  # devices downloaded at the same time
+DOWNLOAD_TIMEOUT = 900  # seconds allowed for one gpsbabel run
+DOWNLOAD_RETRIES = 2  # extra attempts after a failed or timed out download
+INGEST_CHUNK_SIZE = 64 * 1024  # bytes read from gpsbabel at a time
+PROCESSING_WORKERS = 1  # threads splitting files the inline split could not handle
+MAX_QUEUED_FILES = 32  # queued files before ingests wait for the processing workers
+INCREMENTAL_DOWNLOADS = True  # archive only points newer than the device's watermark
+WATERMARK_TAIL_POINTS = 16  # points before the watermark checked against tail_hash
+DOWNLOAD_BACKEND = 'gpsbabel'  # 'gpsbabel', or 'native' (skytraq.py, falls back to gpsbabel)
+NATIVE_INIT_BAUD = 38400  # rate the loggers talk at when plugged in
+NATIVE_BAUD_RATES = skytraq.PREFERRED_BAUDS  # download rates tried, fastest first
+METRICS_TEXTFILE = None  # Prometheus textfile written after each device, e.g. for node_exporter
+METRICS_JSON = None  # JSON metrics snapshot written after each device
+EVENT_LOG = None  # JSON-lines log of detections, downloads and ingests
+PROFILE_DIR = None  # cProfile dump per device download goes here when set
+
+# Serializes the duplicate check and the insert so two devices with the
+# same dump can never both be archived
+db_lock = Lock()
+
+# Set while monitor_serial_ports runs, see queue_processing()
+processing_queue = None
 
 def monitor_serial_ports():
+    global processing_queue
     # Initialize the database
     init_db()
+    gpsMetrics.TEXTFILE = METRICS_TEXTFILE
+    gpsMetrics.JSON_FILE = METRICS_JSON
+    gpsMetrics.EVENT_LOG = EVENT_LOG
+    gpsMetrics.PROFILE_DIR = PROFILE_DIR
+    
+    # Downloads run in parallel, one job per device
+    pool = ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS)
     
-    # Get initial list of devices
-    previous_devices = get_serial_devices()
+    # Devices already plugged in at startup are not downloaded, the watcher
+    # only reports what appears or disappears from now on
+    watcher = create_watcher(SERIAL_BY_ID_DIR, WATCH_BACKEND, CHECK_INTERVAL)
+    
+    # Files left unprocessed by an earlier run are fed to the workers from
+    # a thread: submit() blocks while the queue is full, and a big backlog
+    # (e.g. after a reset for reprocessing) must not hold up the watching
+    processing_queue = ProcessingQueue(PROCESSING_WORKERS, MAX_QUEUED_FILES)
+    Thread(target=processing_queue.enqueue_pending, daemon=True).start()
     
     while True:
         try:
-            current_devices = get_serial_devices()
-            new_devices = [d for d in current_devices if d not in previous_devices]
-            
-            for device in new_devices:
-                serial_number = extract_serial_number(device)
+            for event, device in watcher.events():
+                if event == 'remove':
+                    print(f"Device removed: {device}")
+                    continue
+                
+                serial_number = deviceRegistry.extract_serial(device)
                 if serial_number:
-                    gps_name = get_gps_name(serial_number)
+                    gps_name = deviceRegistry.name_of(serial_number)
                     if gps_name:
                         print(f"Found new device: {device} with GPS name: {gps_name}")
-                        process_device(device, gps_name)
-            
-            previous_devices = current_devices
-            time.sleep(CHECK_INTERVAL)
+                        with db_lock:
+                            gpsDb.set_device_seen(gpsDb.get_connection(SQLITE_DB), serial_number, gps_name)
+                        gpsMetrics.count('devices_detected_total', device=gps_name)
+                        gpsMetrics.log_event('device_detected', device=gps_name, port=device)
+                        pool.submit(process_device, device, gps_name, time.monotonic())
             
         except KeyboardInterrupt:
             print("Monitoring stopped by user")
+            watcher.close()
+            pool.shutdown(wait=False, cancel_futures=True)
+            processing_queue.shutdown()
             break
         except Exception as e:
             print(f"Error: {e}")
             time.sleep(CHECK_INTERVAL)
 
-def get_serial_devices():
-    try:
-        devices = os.listdir('/dev/serial/by-id')
-        return [d for d in devices if os.path.islink(f'/dev/serial/by-id/{d}')]
-    except FileNotFoundError:
-        return []
+def download_device(device_path, gps_name, serial_number=None):
+    if DOWNLOAD_BACKEND == 'native':
+        result = download_device_native(device_path, gps_name, serial_number)
+        if result is not None:
+            return result
+        print(f"Native download not possible on {device_path}, using gpsbabel")
+    return download_device_gpsbabel(device_path, gps_name, serial_number)
 
-def extract_serial_number(device_name):
-    # Look for 12 hex digits in the device name
-    match = re.search(r'([0-9A-Fa-f]{12})', device_name)
-    return match.group(1).upper() if match else None
+def download_device_native(device_path, gps_name, serial_number=None):
+    # Read the log with skytraq.py at the fastest rate the device accepts,
+    # starting one sector before the sector that was being written at the
+    # last download so the watermark tail check still sees enough points.
+    # Returns None if the device does not answer the binary protocol.
+    incremental = INCREMENTAL_DOWNLOADS
+    attempt = 0
+    while attempt <= DOWNLOAD_RETRIES:
+        attempt += 1
+        first_sector = 0
+        if incremental and serial_number:
+            with db_lock:
+                last_sector = gpsDb.get_last_sector(gpsDb.get_connection(SQLITE_DB), serial_number)
+            first_sector = max(0, (last_sector or 0) - 1)
+        baud_rates = native_baud_rates(serial_number)
+        
+        ingest = GpxIngest(gps_name, serial_number, incremental)
+        started = time.monotonic()
+        try:
+            with skytraq.SkyTraqReader(device_path, NATIVE_INIT_BAUD) as reader:
+                try:
+                    baud = reader.negotiate(baud_rates)
+                except skytraq.SkyTraqError:
+                    return None
+                print(f"Reading {device_path} at {baud} baud from sector {first_sector}")
+                ingest.read_stream(reader.gpx_stream(first_sector))
+            record_download(gps_name, serial_number, ingest, time.monotonic() - started, 'native', baud)
+            ingest.commit()
+            if serial_number:
+                with db_lock:
+                    gpsDb.set_last_sector(gpsDb.get_connection(SQLITE_DB), serial_number,
+                                          reader.last_sector)
+            return True
+        except WatermarkMismatch as e:
+            print(f"{e}, downloading {device_path} in full")
+            incremental = False
+            attempt -= 1
+        except (skytraq.SkyTraqError, OSError) as e:
+            print(f"Native download failed on {device_path} (attempt {attempt}): {e}")
+        except Exception as e:
+            print(f"Error processing GPX data from {device_path}: {e}")
+            return False
+        finally:
+            ingest.discard()
+    return False
 
-def get_gps_name(serial_number):
-    try:
-        with open(SERIAL2NAME_FILE, 'r') as f:
-            for line in f:
-                parts = line.strip().split()
-                if parts and parts[0] == serial_number:
-                    return parts[1]
-    except FileNotFoundError:
-        print(f"Warning: {SERIAL2NAME_FILE} not found")
-    return None
-
-def process_device(device_name, gps_name):
-    device_path = f'/dev/serial/by-id/{device_name}'
-    
-    # Run gpsbabel command
+def native_baud_rates(serial_number=None):
+    # NATIVE_BAUD_RATES with the rate the device last downloaded at tried
+    # first, so a unit that refuses the fastest rate doesn't fail it every time
+    preferred = None
+    if serial_number:
+        with db_lock:
+            state = gpsDb.get_device_state(gpsDb.get_connection(SQLITE_DB), serial_number)
+        preferred = state[5] if state else None
+    if preferred not in NATIVE_BAUD_RATES or preferred <= NATIVE_INIT_BAUD:
+        return NATIVE_BAUD_RATES
+    return (preferred,) + tuple(baud for baud in NATIVE_BAUD_RATES if baud != preferred)
+
+def download_device_gpsbabel(device_path, gps_name, serial_number=None):
+    # Stream gpsbabel's output straight into the ingest, retrying on
+    # failure or timeout
     cmd = ['gpsbabel', '-i', 'skytraq,baud=38400,initbaud=38400', 
-           '-f', device_path, '-o', 'gpx', '-F', GPX_FILE]
-    subprocess.run(cmd, check=True)
-    
-    if not os.path.exists(GPX_FILE):
-        print(f"Error: {GPX_FILE} not created")
-        return
-    
-    # Process the GPX file
-    try:
-        # Read and remove line 3
-        with open(GPX_FILE, 'r') as f:
-            lines = f.readlines()
+           '-f', device_path, '-o', 'gpx', '-F', '-']
+    incremental = INCREMENTAL_DOWNLOADS
+    attempt = 0
+    while attempt <= DOWNLOAD_RETRIES:
+        attempt += 1
+        started = time.monotonic()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        timer = Timer(DOWNLOAD_TIMEOUT, proc.kill)
+        timer.start()
+        ingest = GpxIngest(gps_name, serial_number, incremental)
+        error = None
+        try:
+            ingest.read_stream(proc.stdout)
+        except Exception as e:
+            error = e
         
-        if len(lines) < 3:
-            print("Error: GPX file too short")
+        # Closing the pipe stops a gpsbabel we gave up reading from
+        proc.stdout.close()
+        returncode = proc.wait()
+        timer.cancel()
+        try:
+            if isinstance(error, WatermarkMismatch):
+                # The device history changed, download everything again
+                print(f"{error}, downloading {device_path} in full")
+                incremental = False
+                attempt -= 1
+            elif returncode == -signal.SIGKILL:
+                print(f"gpsbabel timed out on {device_path} (attempt {attempt})")
+                gpsMetrics.count('download_failures_total', device=gps_name, reason='timeout')
+            elif returncode != 0 and returncode != -signal.SIGPIPE:
+                print(f"gpsbabel command failed on {device_path} (attempt {attempt}): exit status {returncode}")
+                gpsMetrics.count('download_failures_total', device=gps_name, reason='error')
+            elif error is not None:
+                print(f"Error processing GPX data from {device_path}: {error}")
+                return False
+            else:
+                record_download(gps_name, serial_number, ingest, time.monotonic() - started, 'gpsbabel')
+                ingest.commit()
+                return True
+        except Exception as e:
+            print(f"Error processing GPX data from {device_path}: {e}")
+            return False
+        finally:
+            ingest.discard()
+    return False
+
+def process_device(device_name, gps_name, detected_at=None):
+    if detected_at is not None:
+        # Time spent waiting for a free download worker
+        gpsMetrics.observe('queue', time.monotonic() - detected_at, device=gps_name)
+    device_path = os.path.join(SERIAL_BY_ID_DIR, device_name)
+    try:
+        with gpsMetrics.profiled(f"download-{gps_name}"):
+            download_device(device_path, gps_name, deviceRegistry.extract_serial(device_name))
+        gpsMetrics.write_snapshot()
+    except Exception as e:
+        # Runs in the download pool, where nobody reads the future
+        print(f"Error downloading {device_path}: {e}")
+        gpsMetrics.count('download_failures_total', device=gps_name, reason='error')
+        gpsMetrics.log_event('download_failed', device=gps_name, error=str(e))
+
+def record_download(gps_name, serial_number, ingest, seconds, backend, baud=None):
+    # Transfer time and bandwidth of a finished download (the ingest runs
+    # while the data arrives, so it is included)
+    if serial_number:
+        with db_lock:
+            gpsDb.set_device_download(gpsDb.get_connection(SQLITE_DB), serial_number, seconds,
+                                      ingest.bytes_in, baud)
+    gpsMetrics.observe('download', seconds, device=gps_name)
+    gpsMetrics.count('download_bytes_total', ingest.bytes_in, device=gps_name)
+    if seconds > 0:
+        gpsMetrics.gauge('download_bytes_per_second', round(ingest.bytes_in / seconds), device=gps_name)
+    gpsMetrics.log_event('download_finished', device=gps_name, backend=backend, bytes=ingest.bytes_in,
+                         seconds=round(seconds, 3))
+
+def process_gpx_download(gpx_file, gps_name, serial_number=None):
+    # Ingest an already downloaded gpsbabel GPX file
+    for incremental in (INCREMENTAL_DOWNLOADS, False):
+        ingest = GpxIngest(gps_name, serial_number, incremental)
+        try:
+            with gpsCompress.open_file(gpx_file) as f:
+                ingest.read_stream(f)
+            ingest.commit()
             return
+        except WatermarkMismatch as e:
+            print(f"{e}, ingesting {gpx_file} in full")
+        except Exception as e:
+            print(f"Error processing GPX file: {e}")
+            return
+        finally:
+            ingest.discard()
+
+class WatermarkMismatch(Exception):
+    pass
+
+class TrkptFilter:
+    # Drops the <trkpt> blocks at or before a device's watermark (the
+    # newest point already archived) from a GPX byte stream, everything
+    # else passes through unchanged. The blocks just before the first new
+    # one must hash to the stored tail_hash, otherwise the device history
+    # is not what was archived and WatermarkMismatch is raised.
+    def __init__(self, last_ms=None, tail_hash=None):
+        self.last_ms = last_ms
+        self.tail_hash = tail_hash
+        self.tail = deque(maxlen=WATERMARK_TAIL_POINTS)
+        self.pending = b''
+        self.kept = 0
+        self.dropped = 0
+        self.newest_ms = None
+        self.newest_time = None
+
+    def feed(self, data, final=False):
+        buf = self.pending + data
+        out = []
+        pos = 0
+        while True:
+            start = buf.find(b'<trkpt', pos)
+            end = buf.find(b'</trkpt>', start) if start >= 0 else -1
+            if end < 0:
+                break
+            block_end = end + 8
+            if block_end == len(buf) and not final:
+                break  # The line break may still be coming
+            if buf[block_end:block_end + 1] == b'\n':
+                block_end += 1
             
-        time_line = lines[2].strip()
-        del lines[2]
-        
-        # Write back the modified file
-        with open(GPX_FILE, 'w') as f:
-            f.writelines(lines)
-            
-        # Calculate MD5 hash
-        md5_hash = calculate_md5(GPX_FILE)
+            # Whole lines, so dropped blocks leave no blank indentation
+            line_start = max(pos, buf.rfind(b'\n', pos, start) + 1)
+            out.append(buf[pos:line_start])
+            self.block(buf[line_start:block_end], out)
+            pos = block_end
         
-        # Check if file exists in database
-        if not file_exists_in_db(md5_hash):
-            # Extract timestamp from the removed line
-            timestamp = extract_timestamp(time_line)
-            if timestamp:
-                # Create destination filename
-                dest_filename = create_destination_filename(gps_name, timestamp)
-                dest_path = os.path.join(DESTINATION_CATALOG, dest_filename)
-                
-                # Copy file
-                os.system(f'cp {GPX_FILE} {dest_path}')
-                
-                # Add to database with full timestamp
-                add_to_db(dest_filename, md5_hash, time_line)
-                print(f"Saved new GPS data to {dest_path}")
-                
-                # Start background processing
-                start_background_processing(dest_path)
-            else:
-                print("Could not extract timestamp from GPX file")
+        if final:
+            hold = len(buf)
+            if not self.kept:
+                self.check_tail()
+        elif start >= 0:
+            hold = max(pos, buf.rfind(b'\n', pos, start) + 1)
         else:
-            print("File already exists in database, skipping")
-            
-    except subprocess.CalledProcessError as e:
-        print(f"gpsbabel command failed: {e}")
-    except Exception as e:
-        print(f"Error processing GPX file: {e}")
-
-def calculate_md5(file_path):
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-def extract_timestamp(time_line):
-    # Extract timestamp from line like "<time>2025-07-19T20:51:40.564Z</time>"
-    match = re.search(r'<time>(\d{4}-\d{2}-\d{2})T(\d{2}):(\d{2})', time_line)
-    if match:
-        date_part = match.group(1)
-        time_part = f"{match.group(2)}{match.group(3)}"
+            hold = max(pos, buf.rfind(b'\n', pos) + 1)
+        out.append(buf[pos:hold])
+        self.pending = buf[hold:]
+        return b''.join(out)
+
+    def block(self, block, out):
+        i = block.find(b'<time>')
+        time_str = block[i + 6:block.find(b'</time>', i)].decode('ascii', 'replace') if i >= 0 else ''
+        t = epoch_ms(time_str)
+        if t is not None and self.last_ms is not None and t <= self.last_ms:
+            self.dropped += 1
+            self.tail.append(block.strip())
+            return
         
-        # Parse the date to get day of month
-        dt = datetime.strptime(date_part, "%Y-%m-%d")
-        day = dt.strftime("%d")
+        if not self.kept:
+            self.check_tail()
+        self.kept += 1
+        out.append(block)
+        self.tail.append(block.strip())
+        if t is not None and (self.newest_ms is None or t > self.newest_ms):
+            self.newest_ms = t
+            self.newest_time = time_str
+
+    def tail_digest(self):
+        return hashlib.md5(b''.join(self.tail)).hexdigest()
+
+    def check_tail(self):
+        if self.dropped and self.tail_digest() != self.tail_hash:
+            raise WatermarkMismatch("Points before the watermark changed")
+
+class GpxIngest:
+    # One pass over gpsbabel's GPX output: drops the volatile header time
+    # line (line 3), hashes the rest, writes it to a temporary archive file
+    # and splits the points into segment CSVs while the data arrives.
+    # commit() then either renames everything into place and records it in
+    # the database, or throws it away if the dump is already known. With a
+    # serial number only points newer than the device's watermark are
+    # archived and split.
+    def __init__(self, gps_name, serial_number=None, incremental=True):
+        self.gps_name = gps_name
+        self.serial_number = serial_number
+        self.filter = None
+        if serial_number:
+            watermark = None
+            if incremental:
+                with db_lock:
+                    watermark = gpsDb.get_watermark(gpsDb.get_connection(SQLITE_DB), serial_number)
+            self.filter = TrkptFilter(*(watermark or ()))
+        self.md5 = hashlib.md5()
+        self.bytes_in = 0
+        self.clock = gpsMetrics.StageClock(device=gps_name)
+        self.reader = splitFiles.GpxPointReader()
+        self.splitter = splitFiles.SegmentSplitter()
+        self.cache = splitFiles.ParseCacheWriter()
+        self.archive_tmp = None
+        self.segments = []  # (output_filename, final paths, stats)
+        self.tiles = gpsTiles.TileCounter()
+        self.split_error = None
+
+    def read_stream(self, stream):
+        header = [stream.readline() for _ in range(3)]
+        if not header[2]:
+            raise ValueError("GPX data too short")
+        self.time_line = header[2].decode('utf-8', 'replace').strip()
+        
+        # Extract timestamp from the removed line
+        time_str = extract_time(self.time_line)
+        if not time_str:
+            raise ValueError("Could not extract timestamp from GPX data")
+        with db_lock:
+            filename = free_destination_filename(destination_filename(self.gps_name, time_str))
+        self.base_name = os.path.splitext(filename)[0]
+        self.dest_filename = gpsCompress.add_extension(filename, ARCHIVE_COMPRESSION)
+        self.dest_path = os.path.join(DESTINATION_CATALOG, self.dest_filename)
         
-        return (day, time_part)
-    return None
+        # Temp file next to the final name so the rename is atomic
+        os.makedirs(os.path.dirname(self.dest_path), exist_ok=True)
+        fd, self.archive_tmp = tempfile.mkstemp(prefix=f'.{os.path.basename(self.dest_filename)}.',
+                                                suffix='.part', dir=os.path.dirname(self.dest_path))
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as raw:
+            # The plain data is hashed and split, only the file is compressed
+            archive = gpsCompress.writer(raw, ARCHIVE_COMPRESSION)
+            self.consume(archive, header[0] + header[1])
+            for chunk in iter(lambda: stream.read(INGEST_CHUNK_SIZE), b''):
+                self.consume(archive, chunk)
+            if self.filter:
+                self.consume(archive, b'', final=True)
+            if archive is not raw:
+                with self.clock.stage('archive'):
+                    archive.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+        self.split(self.splitter.finish())
+
+    def consume(self, archive, data, final=False):
+        self.bytes_in += len(data)
+        clock = self.clock
+        if self.filter:
+            with clock.stage('filter'):
+                data = self.filter.feed(data, final)
+        with clock.stage('hash'):
+            self.md5.update(data)
+        with clock.stage('archive'):
+            archive.write(data)
+        if self.split_error is None:
+            with clock.stage('parse'):
+                chunk = self.reader.feed(data)
+                self.cache.add(chunk)
+            with clock.stage('split'):
+                finished_segments = self.splitter.push(chunk)
+            self.split(finished_segments)
+
+    def split(self, finished_segments):
+        # A splitting problem must not lose the download, the archive is
+        # still saved and left for the background processing
+        try:
+            for segment in finished_segments:
+                i = len(self.segments) + 1
+                csv_path = os.path.join(splitFiles.OUTPUT_DIR,
+                                        splitFiles.segment_relpath(self.base_name, i, segment))
+                os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+                paths = splitFiles.segment_paths(csv_path)
+                output_filename = os.path.relpath(paths[0], splitFiles.OUTPUT_DIR)
+                # Recorded first so discard() also removes a partly written file
+                self.segments.append((output_filename, paths, None))
+                with self.clock.stage('write'):
+                    stats = splitFiles.save_segment(segment, csv_path, suffix='.part')
+                self.segments[-1] = (output_filename, paths, stats)
+                with self.clock.stage('tiles'):
+                    self.tiles.add(segment)
+        except Exception as e:
+            self.split_error = e
+
+    def commit(self):
+        md5_hash = self.md5.hexdigest()
+        if self.filter and self.filter.dropped and not self.filter.kept:
+            print("No new points since the last download, skipping")
+            gpsMetrics.count('dedup_hits_total', device=self.gps_name, kind='watermark')
+            return
+        
+        watermark = None
+        if self.filter and self.filter.newest_ms is not None:
+            watermark = (self.serial_number, self.filter.newest_time, self.filter.newest_ms,
+                         self.filter.tail_digest())
+        
+        # Check and insert under the lock so concurrent workers can't
+        # archive the same dump twice
+        with db_lock, gpsMetrics.timer('db', device=self.gps_name):
+            conn = gpsDb.get_connection(SQLITE_DB)
+            if file_exists_in_db(md5_hash):
+                print("File already exists in database, skipping")
+                gpsMetrics.count('dedup_hits_total', device=self.gps_name, kind='md5')
+                # These points are archived, the next dump need not have them
+                if watermark:
+                    gpsDb.set_watermark(conn, *watermark)
+                return
+            
+            segment_rows = tile_rows = None
+            if self.split_error is None:
+                segment_rows = [splitFiles.segment_row(None, output_filename, stats)
+                                for output_filename, _, stats in self.segments]
+                tile_rows = self.tiles.rows(gpsLayout.device_name(self.dest_filename))
+            
+            # The archive and segment files are put in place and the file
+            # row (with its full timestamp), its segments and the watermark
+            # stored in one transaction; on any error the files placed so
+            # far go again, so there is never an archive without its row
+            placed = []
+            try:
+                place_archive(self.archive_tmp, self.dest_path)
+                placed.append(self.dest_path)
+                if self.split_error is None:
+                    for _, paths, _ in self.segments:
+                        for path in paths:
+                            os.replace(path + '.part', path)
+                            placed.append(path)
+                file_id = gpsDb.save_downloaded_file(conn, self.dest_filename, md5_hash, self.time_line,
+                                                     segment_rows, tile_rows, watermark)
+            except Exception:
+                for path in placed:
+                    if os.path.exists(path):
+                        os.remove(path)
+                raise
+            os.remove(self.archive_tmp)
+            self.archive_tmp = None
+            if self.split_error is None:
+                for i, (_, paths, stats) in enumerate(self.segments, start=1):
+                    print(f"Saved segment {i} to {paths[0]} with {stats['count']} points")
+                coSessions.update_groups(conn)
+                self.cache.commit(md5_hash)
+        print(f"Saved new GPS data to {self.dest_path}")
+        if ARCHIVE_LAYOUT == 'partitioned':
+            gpsLayout.record(DESTINATION_CATALOG, self.dest_filename, kind='gpx', content_md5=md5_hash,
+                             device=self.gps_name, serial=self.serial_number)
+        if self.split_error is None and splitFiles.OUTPUT_LAYOUT == 'partitioned':
+            for _, paths, stats in self.segments:
+                for path in paths:
+                    splitFiles.record_segment(path, self.dest_filename, stats)
+        points = sum(stats['count'] for _, _, stats in self.segments) if self.split_error is None else 0
+        gpsMetrics.count('points_total', points, device=self.gps_name)
+        gpsMetrics.count('segments_total', len(self.segments) if points else 0, device=self.gps_name)
+        gpsMetrics.count('archive_bytes_total', os.path.getsize(self.dest_path), device=self.gps_name)
+        gpsMetrics.log_event('ingest_committed', device=self.gps_name, file=self.dest_filename,
+                             points=points, split_error=self.split_error)
+        
+        if self.split_error is not None:
+            print(f"Error splitting {self.dest_filename}: {self.split_error}")
+            # Leave it to the processing workers
+            queue_processing(file_id, self.dest_filename)
+
+    def discard(self):
+        self.clock.flush()
+        self.cache.discard()
+        # Remove whatever was not committed
+        leftovers = [self.archive_tmp] if self.archive_tmp else []
+        leftovers += [path + '.part' for _, paths, _ in self.segments for path in paths]
+        for path in leftovers:
+            if os.path.exists(path):
+                os.remove(path)
+        self.archive_tmp = None
+
+def place_archive(tmp_path, dest_path):
+    # Puts a finished archive under its name, failing instead of replacing
+    # an archive that took the name since read_stream(). A hard link where
+    # the file system has them, else an exclusive create and a copy (exFAT
+    # and CIFS volumes refuse links)
+    try:
+        os.link(tmp_path, dest_path)
+        return
+    except FileExistsError:
+        raise FileExistsError(f"{dest_path} exists, not overwriting it")
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOSYS, errno.EMLINK):
+            raise
+    try:
+        fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        raise FileExistsError(f"{dest_path} exists, not overwriting it")
+    try:
+        with os.fdopen(fd, 'wb') as dest, open(tmp_path, 'rb') as source:
+            shutil.copyfileobj(source, dest)
+            dest.flush()
+            os.fsync(dest.fileno())
+    except BaseException:
+        os.remove(dest_path)
+        raise
+
+def extract_time(time_line):
+    # Time string of a line like "<time>2025-07-19T20:51:40.564Z</time>"
+    start = time_line.find('<time>')
+    end = time_line.find('</time>', start)
+    if start < 0 or end < 0:
+        return None
+    time_str = time_line[start + 6:end]
+    if epoch_ms(time_str) is None:
+        return None
+    return time_str
 
 def create_destination_filename(gps_name, timestamp):
     day, time_str = timestamp
-    # Remove any '#' from gps_name and replace with nothing
-    clean_name = gps_name.replace('#', '')
+    # 'GPS#05' and 'gps05' both give gps05_...
+    clean_name = deviceRegistry.canonical_name(gps_name)
     return f"{clean_name}_{day}{time_str}.gpx"
 
+def destination_filename(gps_name, time_str, layout=None):
+    # Archive name relative to DESTINATION_CATALOG. The flat names only
+    # carry the day of the month; the partitioned ones have the full date
+    # and seconds so they never collide.
+    if (layout or ARCHIVE_LAYOUT) != 'partitioned':
+        return create_destination_filename(gps_name, (time_str[8:10], time_str[11:13] + time_str[14:16]))
+    clean_name = deviceRegistry.canonical_name(gps_name)
+    ms = epoch_ms(time_str)
+    return os.path.join(gpsLayout.partition(clean_name, ms), f"{clean_name}_{utc_datetime(ms):%Y%m%d_%H%M%S}.gpx")
+
+def free_destination_filename(filename):
+    # filename, or with _2, _3, ... before the extension while an archive
+    # of that name (in any compression) is on disk or in gps_files; the
+    # flat names only have the day and minute, so two dumps can share one.
+    # Called under db_lock.
+    conn = gpsDb.get_connection(SQLITE_DB)
+    stem, extension = os.path.splitext(filename)
+    n = 1
+    while True:
+        candidate = filename if n == 1 else f"{stem}_{n}{extension}"
+        on_disk = gpsCompress.existing_variants(os.path.join(DESTINATION_CATALOG, candidate))
+        in_db = any(gpsDb.filename_exists(conn, gpsCompress.add_extension(candidate, c))
+                    for c in gpsCompress.COMPRESSIONS)
+        if not on_disk and not in_db:
+            return candidate
+        n += 1
+
 def init_db():
-    conn = sqlite3.connect(SQLITE_DB)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS gps_files
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  filename TEXT UNIQUE,
-                  md5_hash TEXT UNIQUE,
-                  timestamp TEXT,
-                  processingState INTEGER DEFAULT 0)''')
-    conn.commit()
-    conn.close()
+    # Opens the shared connection and brings the schema up to date
+    gpsDb.get_connection(SQLITE_DB)
+    os.makedirs(DESTINATION_CATALOG, exist_ok=True)
+    os.makedirs(splitFiles.OUTPUT_DIR, exist_ok=True)
+    splitFiles.remove_stale_cache_parts()
 
 def file_exists_in_db(md5_hash):
-    conn = sqlite3.connect(SQLITE_DB)
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM gps_files WHERE md5_hash=?", (md5_hash,))
-    exists = c.fetchone() is not None
-    conn.close()
-    return exists
-
-def add_to_db(filename, md5_hash, timestamp):
-    conn = sqlite3.connect(SQLITE_DB)
-    c = conn.cursor()
-    c.execute("INSERT INTO gps_files (filename, md5_hash, timestamp) VALUES (?, ?, ?)", 
-              (filename, md5_hash, timestamp))
-    conn.commit()
-    conn.close()
-
-def start_background_processing(file_path):
-    def run_processing_script():
-        try:
-            script_path = os.path.expanduser(PROCESS_DATA_SCRIPT)
-            if os.path.exists(script_path):
-                subprocess.Popen([script_path, file_path])
-                print(f"Started background processing with: {script_path} {file_path}")
-            else:
-                print(f"Warning: Processing script {script_path} not found")
-        except Exception as e:
-            print(f"Error starting background process: {e}")
-    
-    # Start in a separate thread to avoid blocking
-    Thread(target=run_processing_script).start()
+    return gpsDb.file_exists(gpsDb.get_connection(SQLITE_DB), md5_hash)
+
+def queue_processing(file_id, filename):
+    # Queued for the daemon's workers; called outside the daemon (e.g.
+    # process_gpx_download from a script) the file is processed right away
+    if processing_queue is not None:
+        processing_queue.submit(file_id, filename)
+    else:
+        process_pending_file(file_id, filename)
+
+def process_pending_file(file_id, filename):
+    # splitFiles' per-file processing, in this process, on the file as
+    # archived under DESTINATION_CATALOG
+    with db_lock:
+        info = gpsDb.file_info(gpsDb.get_connection(SQLITE_DB), file_id)
+    if info is None or info[0] != 0:
+        return  # Done meanwhile, e.g. by a splitFiles.py run
+    with gpsMetrics.timer('processing'):
+        file_id, state, segment_rows, tile_rows = splitFiles.process_file(
+            (file_id, filename, info[1], splitFiles.OUTPUT_FORMAT, splitFiles.OUTPUT_COMPRESSION,
+             splitFiles.OUTPUT_LAYOUT, splitFiles.MAX_GAP_TIME, DESTINATION_CATALOG))
+    if state is not None:
+        with db_lock:
+            gpsDb.save_file_segments(gpsDb.get_connection(SQLITE_DB), file_id, segment_rows, state, tile_rows)
+            coSessions.update_groups(gpsDb.get_connection(SQLITE_DB))
+
+class ProcessingQueue:
+    # Processes gps_files rows with a fixed number of worker threads. A
+    # file waiting or being processed is not queued again, and submit()
+    # blocks once max_queued files are waiting, which holds back the
+    # download workers instead of piling up work.
+    def __init__(self, workers=1, max_queued=32):
+        self.jobs = queue.Queue(max_queued)
+        self.active = set()  # file ids queued or in progress
+        self.lock = Lock()
+        self.threads = [Thread(target=self.worker, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, file_id, filename):
+        with self.lock:
+            if file_id in self.active:
+                gpsMetrics.count('processing_coalesced_total')
+                return False
+            self.active.add(file_id)
+        self.jobs.put((file_id, filename))
+        gpsMetrics.gauge('processing_queue_depth', self.jobs.qsize())
+        return True
+
+    def enqueue_pending(self):
+        with db_lock:
+            pending = gpsDb.pending_files(gpsDb.get_connection(SQLITE_DB))
+        if pending:
+            print(f"Queued {len(pending)} unprocessed files")
+        for file_id, filename, _ in pending:
+            self.submit(file_id, filename)
+
+    def worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            file_id, filename = job
+            try:
+                process_pending_file(file_id, filename)
+            except Exception as e:
+                print(f"Error processing {filename}: {e}")
+            finally:
+                with self.lock:
+                    self.active.discard(file_id)
+                self.jobs.task_done()
+                gpsMetrics.gauge('processing_queue_depth', self.jobs.qsize())
+
+    def shutdown(self):
+        # Workers finish their current file and stop, queued files stay
+        # pending in the database for the next start
+        while True:
+            try:
+                self.jobs.get_nowait()
+                self.jobs.task_done()
+            except queue.Empty:
+                break
+        for _ in self.threads:
+            self.jobs.put(None)
 
 if __name__ == "__main__":
     monitor_serial_ports()
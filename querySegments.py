@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+# Finds the track segments that passed through an area in a time range,
+# using the R-tree index over gpx_segments. With --refine the segment
+# CSVs are read to keep only segments with a point inside both.
+#
+# Usage: querySegments.py --bbox MIN_LAT,MIN_LON,MAX_LAT,MAX_LON
+#                         [--from 2025-07-01] [--to 2025-07-31T18:00:00Z] [--refine]
+
+import os
+import csv
+import sys
+import argparse
+import gpsDb
+import gpsSegment
+import gpsCompress
+import splitFiles
+from gpsTime import epoch_ms, epoch_seconds
+
+SQLITE_DB = 'gps_data.db'
+
+def parse_bound(value, end_of_day=False):
+    # 'YYYY-MM-DD' or a full 'YYYY-MM-DDTHH:MM:SS[.fff]Z' timestamp, as epoch seconds
+    if value is None:
+        return None
+    if len(value) == 10:
+        value += 'T23:59:59Z' if end_of_day else 'T00:00:00Z'
+    seconds = epoch_seconds(value)
+    if seconds is None:
+        raise argparse.ArgumentTypeError(f"Bad time: {value}")
+    return seconds
+
+def parse_bbox(value):
+    try:
+        min_lat, min_lon, max_lat, max_lon = (float(v) for v in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Bad bounding box: {value}")
+    return min(min_lat, max_lat), min(min_lon, max_lon), max(min_lat, max_lat), max(min_lon, max_lon)
+
+def segment_has_point(path, bbox, start_s, end_s):
+    # True if any point of the segment file lies in the box and time range
+    min_lat, min_lon, max_lat, max_lon = bbox
+    start_ms = -float('inf') if start_s is None else start_s * 1000
+    end_ms = float('inf') if end_s is None else end_s * 1000 + 999
+    if path.endswith(gpsSegment.EXTENSION):
+        with gpsSegment.SegmentFile(path) as seg:
+            return any(min_lat <= lat <= max_lat and min_lon <= lon <= max_lon and
+                       start_ms <= t <= end_ms for lat, lon, t in zip(seg.lat, seg.lon, seg.time))
+    with gpsCompress.open_file(path, 'rt', newline='') as f:
+        for row in csv.DictReader(f):
+            lat = float(row['latitude'])
+            lon = float(row['longitude'])
+            if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+                continue
+            t = epoch_ms(row['timestamp'])
+            if t is not None and start_ms <= t <= end_ms:
+                return True
+    return False
+
+def find_segments(bbox, start_s=None, end_s=None, refine=False, db_path=SQLITE_DB):
+    conn = gpsDb.get_connection(db_path)
+    for row in gpsDb.query_segments(conn, *bbox, start_s, end_s):
+        if refine:
+            path = os.path.join(splitFiles.OUTPUT_DIR, row[2])
+            try:
+                if not segment_has_point(path, bbox, start_s, end_s):
+                    continue
+            except FileNotFoundError:
+                print(f"Warning: {path} not found", file=sys.stderr)
+                continue
+        yield row
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find track segments by area and time range")
+    parser.add_argument('--bbox', type=parse_bbox, required=True,
+                        help="MIN_LAT,MIN_LON,MAX_LAT,MAX_LON")
+    parser.add_argument('--from', dest='start', help="start date or timestamp (UTC)")
+    parser.add_argument('--to', dest='end', help="end date or timestamp (UTC)")
+    parser.add_argument('--refine', action='store_true',
+                        help="check the segment points, not only the bounding boxes")
+    parser.add_argument('--db', default=SQLITE_DB, help="database file")
+    args = parser.parse_args()
+    try:
+        start_s = parse_bound(args.start)
+        end_s = parse_bound(args.end, end_of_day=True)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    count = 0
+    for seg_id, gpx_id, filename, start_time, end_time, record_count, *_ in find_segments(
+            args.bbox, start_s, end_s, args.refine, args.db):
+        print(f"{filename}\t{start_time}\t{end_time}\t{record_count}")
+        count += 1
+    print(f"{count} segments found", file=sys.stderr)
@@ -26,9 +26,8 @@ devices = discover_devices()
 #iint(devices)
 
 
-import re
-
 from datetime import datetime
+from deviceRegistry import DeviceRegistry, extract_serial
 
 def get_current_date_time():
     # Get current date and time, then format it
@@ -36,13 +35,11 @@ def get_current_date_time():
 
 
 def extract_serial_number(device_name):
-    # Pattern to match serial number in names like 'usb-STMicroelectronics_STM32_Virtual_COM_Port_0A7831533334-if00'
-    match = re.search(r'_(\w{12})-if\d+', device_name)
-    if match:
-        return match.group(1)
-    else:
+    # Serial number in names like 'usb-STMicroelectronics_STM32_Virtual_COM_Port_0A7831533334-if00'
+    serial_number = extract_serial(device_name)
+    if serial_number is None:
         print(f"Serial number not found in device name: {device_name}")
-        return None
+    return serial_number
 
 import subprocess
 
@@ -64,28 +61,40 @@ def run_gpsbabel( input_device, output_format, output_file, baud_rate=38400, ini
     except subprocess.CalledProcessError as e:
         print(f"An error occurred while running gpsbabel: {e}")
 
+
+import skytraq
+
+def read_log(input_device, output_file):
+    # Read the log with skytraq.py at the fastest baud rate the device
+    # accepts; gpsbabel at a fixed 38400 only if the device doesn't answer
+    try:
+        with skytraq.SkyTraqReader(input_device) as reader:
+            baud = reader.negotiate()
+            stream = reader.gpx_stream()
+            with open(output_file, 'wb') as f:
+                for chunk in iter(lambda: stream.read(65536), b''):
+                    f.write(chunk)
+        print(f"Log read at {baud} baud. Output saved to {output_file}.")
+    except (skytraq.SkyTraqError, OSError) as e:
+        print(f"Native read failed on {input_device} ({e}), using gpsbabel")
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        run_gpsbabel(input_device, "gpx", output_file)
+
      
 # Example usage:
 #device_name = 'usb-STMicroelectronics_STM32_Virtual_COM_Port_0A7831533334-if00'
 #serial_number = extract_serial_number(device_name)
 #print(serial_number)
 
+registries = {}  # mapping file -> DeviceRegistry, read once
+
 def translate_serial_to_name(serial_number, filename):
-    # Open the file containing the serial-to-name mapping
-    try:
-        with open(filename, 'r') as file:
-            for line in file:
-                # Split the line into serial_number and device_name
-                parts = line.strip().split()
-                if len(parts) == 2:
-                    file_serial, device_name = parts
-                    if file_serial == serial_number:
-                        return device_name
+    registry = registries.setdefault(filename, DeviceRegistry([filename]))
+    device_name = registry.name_of(serial_number)
+    if device_name is None:
         print(f"Serial number {serial_number} not found in the file.")
-        return None
-    except FileNotFoundError:
-        print(f"File {filename} not found.")
-        return None
+    return device_name
 
 # Example usage:
 #serial_number = '0A7831533334'
@@ -110,8 +119,7 @@ for device in devices:
 #    print(f"Running with args: '{arguments}'")
 #    subprocess.run(["/usr/bin/gpsbabel",'-i skytraq,initbaud=38400,baud=38400',f"-f {device}","-o gpx", f"-F {filename_out}"]);
     # Example usage
-    run_gpsbabel(
+    read_log(
         input_device=f"/dev/serial/by-id/{device}",
-        output_format="gpx",
         output_file=filename_out
     )
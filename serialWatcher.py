@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+# Watches a /dev/serial/by-id style directory and reports devices that
+# appear or disappear.  InotifyWatcher gets the events straight from the
+# kernel (no udev daemon needed), PollingWatcher is the old listdir loop
+# and is used where inotify is not available.
+
+import os
+import time
+import ctypes
+import ctypes.util
+import struct
+import selectors
+from collections import deque
+
+# inotify constants from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+DIR_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM |
+            IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+PARENT_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+def list_devices(path):
+    try:
+        return {d for d in os.listdir(path) if os.path.islink(os.path.join(path, d))}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+class PollingWatcher:
+    def __init__(self, path, interval=5):
+        self.path = path
+        self.interval = interval
+        self.known = list_devices(path)
+        self.pending = deque()
+
+    def _deliver(self, changes=()):
+        # Changes are taken off self.pending one at a time, so the ones not
+        # handed out yet when the consumer raises come with the next events()
+        self.pending.extend(changes)
+        while self.pending:
+            yield self.pending.popleft()
+
+    def events(self, timeout=None):
+        # Yields ('add', name) and ('remove', name) forever, or until
+        # timeout seconds passed without any change
+        yield from self._deliver()
+        idle_since = time.monotonic()
+        while True:
+            current = list_devices(self.path)
+            changes = self._diff(current)
+            if changes:
+                yield from self._deliver(changes)
+                idle_since = time.monotonic()
+            elif timeout is not None and time.monotonic() - idle_since >= timeout:
+                return
+            time.sleep(self.interval)
+
+    def _diff(self, current):
+        changes = [('remove', d) for d in sorted(self.known - current)]
+        changes += [('add', d) for d in sorted(current - self.known)]
+        self.known = current
+        return changes
+
+    def close(self):
+        pass
+
+class InotifyWatcher(PollingWatcher):
+    def __init__(self, path):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.path = os.path.abspath(path)
+        self.wd = None
+        self.known = set()
+        self.pending = deque()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.fd, selectors.EVENT_READ)
+        self._arm()
+        self.known = list_devices(self.path)
+
+    def _add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+        return wd
+
+    def _arm(self):
+        # Watch the directory itself if it exists.  udev only creates
+        # /dev/serial/by-id when the first device shows up, so otherwise
+        # watch the nearest existing parent and re-arm when it changes.
+        if self.wd is not None:
+            self.libc.inotify_rm_watch(self.fd, self.wd)
+        watch = self.path
+        mask = DIR_MASK
+        while not os.path.isdir(watch):
+            watch = os.path.dirname(watch)
+            mask = PARENT_MASK
+        self.watching_target = (watch == self.path)
+        self.wd = self._add_watch(watch, mask)
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def events(self, timeout=None):
+        yield from self._deliver()
+        while True:
+            if not self.selector.select(timeout):
+                return
+            changes = []
+            rearm = False
+            for wd, mask, name in self._read_events():
+                if mask & IN_Q_OVERFLOW or not self.watching_target:
+                    rearm = True
+                elif wd != self.wd:
+                    continue
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    rearm = True
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    if name not in self.known and os.path.islink(os.path.join(self.path, name)):
+                        self.known.add(name)
+                        changes.append(('add', name))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    if name in self.known:
+                        self.known.discard(name)
+                        changes.append(('remove', name))
+            if rearm:
+                # Lost track of the directory, rescan and report the difference
+                self._arm()
+                changes += self._diff(list_devices(self.path))
+            yield from self._deliver(changes)
+
+    def close(self):
+        self.selector.close()
+        os.close(self.fd)
+
+def create_watcher(path, backend='auto', interval=5):
+    if backend in ('auto', 'inotify'):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError, TypeError) as e:
+            if backend == 'inotify':
+                raise
+            print(f"inotify not available ({e}), falling back to polling")
+    return PollingWatcher(path, interval)
+
+if __name__ == "__main__":
+    import sys
+    watch_dir = sys.argv[1] if len(sys.argv) > 1 else '/dev/serial/by-id'
+    watcher = create_watcher(watch_dir)
+    print(f"Watching {watch_dir} with {type(watcher).__name__}")
+    try:
+        for kind, device in watcher.events():
+            print(f"{kind}: {device}")
+    except KeyboardInterrupt:
+        watcher.close()
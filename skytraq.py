@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+
+# In-process reader for the SkyTraq data logger binary protocol, so a
+# download doesn't need a gpsbabel run at a fixed 38400 baud reading the
+# whole flash. It switches the unit to the fastest baud rate it accepts,
+# reads only the requested sector range and decodes the log records
+# directly into track points, rendered as gpsbabel-style GPX for the
+# ingest. skytraqEmulator.py serves the same protocol on a pty.
+#
+# Usage: skytraq.py <device> [first_sector] > track.gpx
+
+import os
+import sys
+import math
+import time
+import struct
+import select
+import termios
+from datetime import datetime, timezone
+
+SECTOR_SIZE = 4096
+SECTORS_PER_READ = 8  # sectors requested per read command
+MESSAGE_TIMEOUT = 2.0  # seconds to wait for a reply
+SECTOR_TIMEOUT = 10.0  # seconds to wait for one sector batch
+READ_RETRIES = 3
+
+# Baud rate codes used by the configure serial port command
+BAUD_CODES = {4800: 0, 9600: 1, 19200: 2, 38400: 3, 57600: 4, 115200: 5, 230400: 6}
+TERMIOS_BAUD = {4800: termios.B4800, 9600: termios.B9600, 19200: termios.B19200,
+                38400: termios.B38400, 57600: termios.B57600, 115200: termios.B115200,
+                230400: termios.B230400}
+PREFERRED_BAUDS = (230400, 115200, 57600, 38400)  # tried fastest first
+
+# Message ids
+CMD_QUERY_VERSION = 0x02
+CMD_CONFIGURE_SERIAL = 0x05
+CMD_LOG_STATUS = 0x17
+CMD_READ_SECTORS = 0x1D
+MSG_VERSION = 0x80
+MSG_ACK = 0x83
+MSG_NACK = 0x84
+MSG_LOG_STATUS = 0x94
+
+# Log record types (top three bits of the first byte)
+RECORD_FULL = 0x40
+RECORD_FULL_POI = 0x60
+RECORD_COMPACT = 0x80
+RECORD_EMPTY = 0xE0
+FULL_RECORD_LEN = 18
+COMPACT_RECORD_LEN = 8
+
+GPS_EPOCH = 315964800  # 1980-01-06 in Unix time
+GPS_LEAP_SECONDS = 18  # GPS - UTC
+GPS_WEEK_SECONDS = 604800
+
+# WGS84
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+WGS84_B = WGS84_A * (1 - WGS84_F)
+WGS84_EP2 = (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+
+class SkyTraqError(Exception):
+    pass
+
+class SerialPort:
+    # Raw 8N1 serial port through termios, no pyserial needed
+    def __init__(self, path, baud):
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        self.set_baud(baud)
+
+    def set_baud(self, baud):
+        attrs = termios.tcgetattr(self.fd)
+        attrs[0] = 0  # iflag
+        attrs[1] = 0  # oflag
+        attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+        attrs[3] = 0  # lflag
+        attrs[4] = attrs[5] = TERMIOS_BAUD[baud]
+        attrs[6][termios.VMIN] = 0
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+        self.baud = baud
+
+    def read(self, size, timeout):
+        data = bytearray()
+        deadline = time.monotonic() + timeout
+        while len(data) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                break
+            data += os.read(self.fd, size - len(data))
+        return bytes(data)
+
+    def write(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+        termios.tcdrain(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+def checksum(data):
+    cs = 0
+    for b in data:
+        cs ^= b
+    return cs
+
+def frame(payload):
+    return b'\xa0\xa1' + struct.pack('>H', len(payload)) + payload + bytes([checksum(payload)]) + b'\r\n'
+
+class SkyTraqReader:
+    def __init__(self, path, baud=38400):
+        self.init_baud = baud
+        self.port = SerialPort(path, baud)
+        self.last_sector = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # Leave the unit at the rate it was found at
+        try:
+            if self.port.baud != self.init_baud:
+                self.set_baud(self.init_baud, verify=False)
+        except (SkyTraqError, OSError):
+            pass
+        self.port.close()
+
+    def read_exact(self, size, timeout):
+        data = self.port.read(size, timeout)
+        if len(data) < size:
+            raise SkyTraqError(f"Timeout reading from device ({len(data)}/{size} bytes)")
+        return data
+
+    def read_message(self, timeout=MESSAGE_TIMEOUT):
+        # Skip anything (NMEA text, noise) up to the A0 A1 start sequence
+        deadline = time.monotonic() + timeout
+        prev = b''
+        while True:
+            b = self.port.read(1, max(0, deadline - time.monotonic()))
+            if not b:
+                raise SkyTraqError("Timeout waiting for a message")
+            if prev == b'\xa0' and b == b'\xa1':
+                break
+            prev = b
+        length = struct.unpack('>H', self.read_exact(2, timeout))[0]
+        payload = self.read_exact(length, timeout)
+        trailer = self.read_exact(3, timeout)
+        if trailer[0] != checksum(payload) or trailer[1:] != b'\r\n':
+            raise SkyTraqError("Bad message checksum")
+        return payload
+
+    def command(self, payload, response_id=None, timeout=MESSAGE_TIMEOUT):
+        self.port.write(frame(payload))
+        deadline = time.monotonic() + timeout
+        while True:
+            reply = self.read_message(max(0, deadline - time.monotonic()))
+            if reply[0] in (MSG_ACK, MSG_NACK) and reply[1:2] == payload[:1]:
+                if reply[0] == MSG_NACK:
+                    raise SkyTraqError(f"Command 0x{payload[0]:02x} rejected")
+                break
+        while response_id is not None:
+            reply = self.read_message(max(0, deadline - time.monotonic()))
+            if reply[0] == response_id:
+                return reply
+        return None
+
+    def probe(self):
+        try:
+            self.command(bytes([CMD_QUERY_VERSION, 0x00]), MSG_VERSION, timeout=1.0)
+            return True
+        except SkyTraqError:
+            return False
+
+    def connect(self):
+        # Find the rate the unit is currently talking at
+        for baud in [self.init_baud] + [b for b in BAUD_CODES if b != self.init_baud]:
+            self.port.set_baud(baud)
+            if self.probe():
+                self.init_baud = baud
+                return baud
+        raise SkyTraqError("No response from device at any baud rate")
+
+    def set_baud(self, baud, verify=True):
+        self.command(bytes([CMD_CONFIGURE_SERIAL, 0x00, BAUD_CODES[baud], 0x00]))
+        time.sleep(0.1)
+        self.port.set_baud(baud)
+        if verify and not self.probe():
+            raise SkyTraqError(f"Device not responding at {baud} baud")
+
+    def negotiate(self, bauds=PREFERRED_BAUDS):
+        # Switch to the fastest rate the unit accepts
+        self.connect()
+        current = self.port.baud
+        for baud in bauds:
+            if baud <= current:
+                break
+            try:
+                self.set_baud(baud)
+                return baud
+            except SkyTraqError:
+                self.port.set_baud(current)
+                if not self.probe():
+                    raise
+        return current
+
+    def log_status(self):
+        # (write pointer, free sectors, total sectors)
+        reply = self.command(bytes([CMD_LOG_STATUS]), MSG_LOG_STATUS)
+        return struct.unpack_from('<IHH', reply, 1)
+
+    def read_sectors(self, first, count):
+        expected = count * SECTOR_SIZE
+        for attempt in range(READ_RETRIES):
+            try:
+                self.command(bytes([CMD_READ_SECTORS]) + struct.pack('>HH', first, count))
+                data = self.read_exact(expected + 5, SECTOR_TIMEOUT * count)
+                if data[expected:expected + 4] == b'END\x00' and data[-1] == checksum(data[:expected]):
+                    return data[:expected]
+            except SkyTraqError:
+                pass
+            time.sleep(0.2)
+            termios.tcflush(self.port.fd, termios.TCIFLUSH)
+        raise SkyTraqError(f"Could not read sectors {first}-{first + count - 1}")
+
+    def used_sectors(self):
+        write_ptr, free, total = self.log_status()
+        return min(total, total - free + 1)
+
+    def iter_points(self, first_sector=0):
+        # Yields (time string, lat, lon, ele, speed m/s, name) for every
+        # record from first_sector up to the sector being written
+        used = self.used_sectors()
+        if first_sector >= used:
+            first_sector = 0  # Log was erased since the last download
+        self.last_sector = used - 1
+        state = DecodeState()
+        for start in range(first_sector, used, SECTORS_PER_READ):
+            data = self.read_sectors(start, min(SECTORS_PER_READ, used - start))
+            for i in range(0, len(data), SECTOR_SIZE):
+                sector = start + i // SECTOR_SIZE
+                for n, point in enumerate(decode_sector(data, i, state)):
+                    yield point + (f"TP{sector:04d}{n:03d}",)
+
+    def gpx_stream(self, first_sector=0):
+        return GpxStream(render_gpx(self.iter_points(first_sector)))
+
+class DecodeState:
+    # Compact records are deltas on the last full record
+    def __init__(self):
+        self.week = None
+        self.tow = 0
+        self.x = self.y = self.z = 0
+
+def decode_sector(data, offset, state):
+    end = offset + SECTOR_SIZE
+    pos = offset
+    while pos < end:
+        kind = data[pos] & 0xE0
+        speed_kmh = ((data[pos] & 0x03) << 8) | data[pos + 1]
+        if kind in (RECORD_FULL, RECORD_FULL_POI) and pos + FULL_RECORD_LEN <= end:
+            state.week = ((data[pos + 2] & 0x03) << 8) | data[pos + 3]
+            state.tow = ((data[pos + 2] & 0xF0) << 12) | (data[pos + 4] << 8) | data[pos + 5]
+            state.x, state.y, state.z = (word_swapped(data, pos + 6), word_swapped(data, pos + 10),
+                                         word_swapped(data, pos + 14))
+            pos += FULL_RECORD_LEN
+        elif kind == RECORD_COMPACT and pos + COMPACT_RECORD_LEN <= end:
+            pos += COMPACT_RECORD_LEN
+            if state.week is None:
+                continue  # No full record to apply the delta to
+            state.tow += (data[pos - 6] << 8) | data[pos - 5]
+            dx, dy, dz = compact_deltas(data[pos - 4:pos])
+            state.x += dx
+            state.y += dy
+            state.z += dz
+        else:
+            break  # Empty rest of sector
+
+        lat, lon, alt = ecef_to_lla(state.x, state.y, state.z)
+        yield (gps_time_str(state.week, state.tow), lat, lon, alt, speed_kmh / 3.6)
+
+def word_swapped(data, pos):
+    # Signed 32 bit value stored as two little endian 16 bit words, high word first
+    value = (data[pos + 1] << 24) | (data[pos] << 16) | (data[pos + 3] << 8) | data[pos + 2]
+    return value - (1 << 32) if value & 0x80000000 else value
+
+def pack_word_swapped(value):
+    value &= 0xFFFFFFFF
+    return bytes([(value >> 16) & 0xFF, value >> 24, value & 0xFF, (value >> 8) & 0xFF])
+
+def compact_deltas(b):
+    # 10 bit dx, 10 bit dy, 12 bit dz; values past the midpoint are negative
+    dx = (b[0] << 2) | (b[1] >> 6)
+    dy = ((b[1] & 0x3F) << 4) | (b[2] >> 4)
+    dz = ((b[2] & 0x0F) << 8) | b[3]
+    return (511 - dx if dx >= 512 else dx, 511 - dy if dy >= 512 else dy,
+            2047 - dz if dz >= 2048 else dz)
+
+def encode_full_record(week, tow, x, y, z, speed_kmh=0, poi=False):
+    speed_kmh = min(int(speed_kmh), 1023)
+    return bytes([(RECORD_FULL_POI if poi else RECORD_FULL) | (speed_kmh >> 8), speed_kmh & 0xFF,
+                  ((tow >> 12) & 0xF0) | ((week >> 8) & 0x03), week & 0xFF,
+                  (tow >> 8) & 0xFF, tow & 0xFF]) + pack_word_swapped(x) + pack_word_swapped(y) + pack_word_swapped(z)
+
+def encode_compact_record(dt, dx, dy, dz, speed_kmh=0):
+    # None if the step does not fit a compact record
+    if not (0 <= dt <= 0xFFFF and -512 <= dx <= 511 and -512 <= dy <= 511 and -2048 <= dz <= 2047):
+        return None
+    speed_kmh = min(int(speed_kmh), 1023)
+    ux = dx if dx >= 0 else 511 - dx
+    uy = dy if dy >= 0 else 511 - dy
+    uz = dz if dz >= 0 else 2047 - dz
+    return bytes([RECORD_COMPACT | (speed_kmh >> 8), speed_kmh & 0xFF, dt >> 8, dt & 0xFF,
+                  ux >> 2, ((ux & 0x03) << 6) | (uy >> 4), ((uy & 0x0F) << 4) | (uz >> 8), uz & 0xFF])
+
+def ecef_to_lla(x, y, z):
+    p = math.hypot(x, y)
+    if p == 0 and z == 0:
+        return 0.0, 0.0, 0.0
+    theta = math.atan2(z * WGS84_A, p * WGS84_B)
+    lon = math.atan2(y, x)
+    lat = math.atan2(z + WGS84_EP2 * WGS84_B * math.sin(theta) ** 3,
+                     p - WGS84_E2 * WGS84_A * math.cos(theta) ** 3)
+    n = WGS84_A / math.sqrt(1 - WGS84_E2 * math.sin(lat) ** 2)
+    alt = p / math.cos(lat) - n if abs(math.cos(lat)) > 1e-9 else abs(z) - WGS84_B
+    return math.degrees(lat), math.degrees(lon), alt
+
+def lla_to_ecef(lat, lon, alt):
+    lat, lon = math.radians(lat), math.radians(lon)
+    n = WGS84_A / math.sqrt(1 - WGS84_E2 * math.sin(lat) ** 2)
+    return ((n + alt) * math.cos(lat) * math.cos(lon),
+            (n + alt) * math.cos(lat) * math.sin(lon),
+            (n * (1 - WGS84_E2) + alt) * math.sin(lat))
+
+def gps_time_str(week, tow):
+    # The logger stores a 10 bit week number; pick the rollover era that
+    # puts the point closest to, but not after, the current time
+    seconds = GPS_EPOCH + week * GPS_WEEK_SECONDS + tow - GPS_LEAP_SECONDS
+    era = 1024 * GPS_WEEK_SECONDS
+    now = time.time() + 86400
+    seconds += max(0, int((now - seconds) // era)) * era
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+def render_gpx(points):
+    # gpsbabel's GPX 1.0 layout, so the archive and ingest treat both
+    # download paths the same (line 3 is the download time)
+    now = datetime.now(timezone.utc)
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<gpx version="1.0" creator="renkforce skytraq reader" xmlns="http://www.topografix.com/GPX/1/0">\n'
+           f'  <time>{now:%Y-%m-%dT%H:%M:%S}.{now.microsecond // 1000:03d}Z</time>\n'
+           '  <trk>\n    <trkseg>\n').encode()
+    for time_str, lat, lon, ele, speed, name in points:
+        yield (f'      <trkpt lat="{lat:.9f}" lon="{lon:.9f}">\n'
+               f'        <ele>{ele:.6f}</ele>\n'
+               f'        <time>{time_str}</time>\n'
+               f'        <speed>{speed:.6f}</speed>\n'
+               f'        <name>{name}</name>\n'
+               '      </trkpt>\n').encode()
+    yield b'    </trkseg>\n  </trk>\n</gpx>\n'
+
+class GpxStream:
+    # File-like wrapper (readline/read) around a generator of byte pieces
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.buffer = b''
+
+    def fill(self, size):
+        while len(self.buffer) < size:
+            piece = next(self.pieces, None)
+            if piece is None:
+                return False
+            self.buffer += piece
+        return True
+
+    def readline(self):
+        while b'\n' not in self.buffer and self.fill(len(self.buffer) + 1):
+            pass
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def read(self, size=-1):
+        self.fill(size if size >= 0 else float('inf'))
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: skytraq.py <device> [first_sector] > track.gpx")
+        sys.exit(1)
+    with SkyTraqReader(sys.argv[1]) as reader:
+        baud = reader.negotiate()
+        print(f"Reading at {baud} baud", file=sys.stderr)
+        stream = reader.gpx_stream(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+        for chunk in iter(lambda: stream.read(65536), b''):
+            sys.stdout.buffer.write(chunk)
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+# Serves the SkyTraq logger protocol on a pseudo terminal, for trying
+# skytraq.py and monitorPorts.py without a device. The log flash is built
+# from the points of a GPX file. --check builds the flash, reads it back
+# through skytraq.SkyTraqReader and compares the points.
+#
+# Usage: skytraqEmulator.py <file.gpx> [total_sectors]
+#        skytraqEmulator.py --check [file.gpx]
+
+import os
+import sys
+import tty
+import math
+import time
+import struct
+import select
+from threading import Thread
+import skytraq
+from splitFiles import parse_gpx_file
+
+GPS_UTC_OFFSET = skytraq.GPS_EPOCH - skytraq.GPS_LEAP_SECONDS
+CHECK_POINTS = 1500  # points of the built-in --check track, a few sectors
+CHECK_TOLERANCE_M = 2.0  # the flash keeps whole metres per ECEF axis
+
+def build_flash(points):
+    # points: (epoch seconds, lat, lon, ele, speed m/s). Every sector starts
+    # with a full record, later records are compact when the step fits.
+    sectors = []
+    sector = bytearray()
+    last = None
+    for seconds, lat, lon, ele, speed in points:
+        x, y, z = (round(v) for v in skytraq.lla_to_ecef(lat, lon, ele))
+        gps = int(seconds) - GPS_UTC_OFFSET
+        week, tow = divmod(gps, skytraq.GPS_WEEK_SECONDS)
+        speed_kmh = speed * 3.6 if speed == speed else 0
+        record = None
+        if last is not None and sector:
+            record = skytraq.encode_compact_record(gps - last[0], x - last[1], y - last[2],
+                                                   z - last[3], speed_kmh)
+        if record is None:
+            record = skytraq.encode_full_record(week % 1024, tow, x, y, z, speed_kmh)
+        if len(sector) + len(record) > skytraq.SECTOR_SIZE:
+            sectors.append(bytes(sector).ljust(skytraq.SECTOR_SIZE, b'\xff'))
+            sector = bytearray(skytraq.encode_full_record(week % 1024, tow, x, y, z, speed_kmh))
+        else:
+            sector += record
+        last = (gps, x, y, z)
+    if sector:
+        sectors.append(bytes(sector).ljust(skytraq.SECTOR_SIZE, b'\xff'))
+    return b''.join(sectors)
+
+class SkyTraqEmulator:
+    def __init__(self, flash, total_sectors=None):
+        self.flash = flash
+        self.used_sectors = len(flash) // skytraq.SECTOR_SIZE
+        self.total_sectors = total_sectors or max(self.used_sectors, 1) * 2
+        self.baud = 38400
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.running = True
+        self.thread = Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def send(self, payload):
+        data = skytraq.frame(payload)
+        while data:
+            data = data[os.write(self.master, data):]
+
+    def send_raw(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def serve(self):
+        buf = b''
+        while self.running:
+            if not select.select([self.master], [], [], 0.2)[0]:
+                continue
+            try:
+                buf += os.read(self.master, 4096)
+            except OSError:
+                return
+            while True:
+                start = buf.find(b'\xa0\xa1')
+                if start < 0 or len(buf) < start + 4:
+                    break
+                length = struct.unpack_from('>H', buf, start + 2)[0]
+                end = start + 4 + length + 3
+                if len(buf) < end:
+                    break
+                payload = buf[start + 4:start + 4 + length]
+                buf = buf[end:]
+                self.handle(payload)
+
+    def handle(self, payload):
+        command = payload[0]
+        if command == skytraq.CMD_QUERY_VERSION:
+            self.send(bytes([skytraq.MSG_ACK, command]))
+            self.send(bytes([skytraq.MSG_VERSION, 0x01]) + bytes(12))
+        elif command == skytraq.CMD_CONFIGURE_SERIAL:
+            self.send(bytes([skytraq.MSG_ACK, command]))
+            self.baud = {v: k for k, v in skytraq.BAUD_CODES.items()}[payload[2]]
+        elif command == skytraq.CMD_LOG_STATUS:
+            self.send(bytes([skytraq.MSG_ACK, command]))
+            free = self.total_sectors - max(self.used_sectors - 1, 0)
+            self.send(bytes([skytraq.MSG_LOG_STATUS]) +
+                      struct.pack('<IHH', len(self.flash), free, self.total_sectors))
+        elif command == skytraq.CMD_READ_SECTORS:
+            first, count = struct.unpack_from('>HH', payload, 1)
+            self.send(bytes([skytraq.MSG_ACK, command]))
+            size = count * skytraq.SECTOR_SIZE
+            data = self.flash[first * skytraq.SECTOR_SIZE:][:size].ljust(size, b'\xff')
+            self.send_raw(data + b'END\x00' + bytes([skytraq.checksum(data)]))
+        else:
+            self.send(bytes([skytraq.MSG_NACK, command]))
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+def load_points(gpx_file):
+    points = []
+    for track in parse_gpx_file(gpx_file):
+        for i in range(len(track)):
+            points.append((track.time[i] // 1000, track.lat[i], track.lon[i],
+                           track.ele[i] if track.ele[i] == track.ele[i] else 0.0, track.speed[i]))
+    return points
+
+def check_points(count=CHECK_POINTS):
+    # 1 Hz walk with a gap and a jump too big for compact records
+    points = []
+    seconds, lat, lon, ele = 1752900000, 44.5, 9.5, 120.0
+    for i in range(count):
+        seconds += 3600 if i == count // 2 else 1
+        if i == count // 3:
+            lat += 0.01
+        lat += 2e-5
+        lon += 1e-5 * math.sin(i / 50)
+        ele += math.cos(i / 30)
+        points.append((seconds, lat, lon, ele, (i % 40) / 3.6))
+    return points
+
+def check_round_trip(points):
+    # build_flash -> emulator -> SkyTraqReader.iter_points; returns the
+    # number of points that did not come back as written
+    emulator = SkyTraqEmulator(build_flash(points))
+    try:
+        with skytraq.SkyTraqReader(emulator.path) as reader:
+            reader.negotiate()
+            read = list(reader.iter_points())
+    finally:
+        emulator.close()
+    bad = abs(len(read) - len(points))
+    if bad:
+        print(f"Wrote {len(points)} points, read {len(read)}")
+    for n, ((seconds, lat, lon, ele, speed), (time_str, lat2, lon2, ele2, speed2, _)) in enumerate(zip(points, read)):
+        expected_time = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(int(seconds)))
+        expected_speed = min(int(speed * 3.6 if speed == speed else 0), 1023) / 3.6
+        error_m = math.hypot((lat2 - lat) * 111320, (lon2 - lon) * 111320 * math.cos(math.radians(lat)))
+        if (time_str != expected_time or error_m > CHECK_TOLERANCE_M or abs(ele2 - ele) > CHECK_TOLERANCE_M
+                or abs(speed2 - expected_speed) > 1e-6):
+            print(f"Point {n}: wrote {expected_time} {lat} {lon} {ele} {speed}, "
+                  f"read {time_str} {lat2} {lon2} {ele2} {speed2}")
+            bad += 1
+    return bad
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--check']:
+        points = load_points(sys.argv[2]) if len(sys.argv) > 2 else check_points()
+        bad = check_round_trip(points)
+        print(f"{len(points)} points, {bad} mismatches")
+        sys.exit(1 if bad else 0)
+    if len(sys.argv) < 2:
+        print("Usage: skytraqEmulator.py <file.gpx> [total_sectors] | --check [file.gpx]")
+        sys.exit(1)
+    flash = build_flash(load_points(sys.argv[1]))
+    emulator = SkyTraqEmulator(flash, int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    print(f"Serving {len(flash) // skytraq.SECTOR_SIZE} log sectors on {emulator.path}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.close()
@@ -2,10 +2,13 @@
 import csv
 import sys
 import os
-from datetime import datetime, timedelta
+import glob
+import argparse
+import multiprocessing
+import gpsCompress
+from gpsTime import epoch_seconds, utc_datetime
 
-def parse_time(timestr):
-    return datetime.strptime(timestr, "%Y-%m-%dT%H:%M:%SZ")
+FIELDNAMES = ["Time", "Latitude", "Longitude", "Name", "Elevation", "Speed"]
 
 def format_time(dt):
     return dt.strftime("%H%M")
@@ -13,58 +16,124 @@ def format_time(dt):
 def format_mmdd(dt):
     return dt.strftime("%m%d")
 
-def split_csv_by_time_gap(filename, max_gap_seconds):
-    with open(filename, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        rows = list(reader)
-
-    if not rows:
-        print("No data rows found.")
-        return
+class SessionWriter:
+    # Writes one session straight to a temporary file while the rows are
+    # read; close() renames it once the end time is known
+    def __init__(self, gps_prefix, start_seconds):
+        self.gps_prefix = gps_prefix
+        self.start_seconds = start_seconds
+        self.end_seconds = start_seconds
+        self.tmp_filename = f".{gps_prefix}.{os.getpid()}.part"
+        self.file = open(self.tmp_filename, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(FIELDNAMES)
+
+    def write(self, row, seconds):
+        self.writer.writerow(row)
+        self.end_seconds = seconds
+
+    def close(self):
+        self.file.close()
+        start_time = utc_datetime(self.start_seconds * 1000)
+        end_time = utc_datetime(self.end_seconds * 1000)
+        mmdd = format_mmdd(start_time)
+        start_hhmm = format_time(start_time)
+        end_hhmm = format_time(end_time)
+
+        out_filename = f"{self.gps_prefix}_{mmdd}_{start_hhmm}-{end_hhmm}.csv"
+        os.replace(self.tmp_filename, out_filename)
+        print(f"Wrote: {out_filename}")
+        return out_filename
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
 
-    base_name = os.path.splitext(os.path.basename(filename))[0]
+def split_csv_by_time_gap(filename, max_gap_seconds):
+    # Streams the rows: each session goes to its file as soon as the gap
+    # after it is seen, only the current row is held in memory. Gzip/lzma
+    # compressed inputs (.csv.gz, .csv.xz) are decompressed on the fly.
+    base_name = os.path.splitext(os.path.basename(gpsCompress.strip_extension(filename)))[0]
     gps_prefix = base_name.split('_')[0]
-
-    current_group = []
-    previous_time = None
-    file_count = 0
-
-    for row in rows:
-        current_time = parse_time(row["Time"])
-
-        if previous_time is None or (current_time - previous_time).total_seconds() <= max_gap_seconds:
-            current_group.append(row)
-        else:
-            if current_group:
-                write_segment(current_group, gps_prefix)
-            current_group = [row]
-
-        previous_time = current_time
-
-    if current_group:
-        write_segment(current_group, gps_prefix)
-
-def write_segment(rows, gps_prefix):
-    start_time = parse_time(rows[0]["Time"])
-    end_time = parse_time(rows[-1]["Time"])
-    mmdd = format_mmdd(start_time)
-    start_hhmm = format_time(start_time)
-    end_hhmm = format_time(end_time)
-
-    out_filename = f"{gps_prefix}_{mmdd}_{start_hhmm}-{end_hhmm}.csv"
-
-    with open(out_filename, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=["Time", "Latitude", "Longitude", "Name", "Elevation", "Speed"])
-        writer.writeheader()
-        writer.writerows(rows)
-
-    print(f"Wrote: {out_filename}")
+    written = []
+
+    with gpsCompress.open_file(filename, 'rt', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        if "Time" not in header or any(field not in FIELDNAMES for field in header):
+            raise ValueError(f"{filename}: unexpected columns {header}")
+        # Output column order (Time first), missing columns are written empty
+        order = [header.index(field) if field in header else None for field in FIELDNAMES]
+        reorder = order != list(range(len(FIELDNAMES)))
+
+        session = None
+        previous_time = None
+        try:
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) > len(header):
+                    raise ValueError(f"{filename}: more fields than columns on line {reader.line_num}")
+                if len(row) < len(header):
+                    row += [''] * (len(header) - len(row))
+                if reorder:
+                    row = ['' if i is None else row[i] for i in order]
+                current_time = epoch_seconds(row[0])
+                if current_time is None:
+                    raise ValueError(f"Bad time: {row[0]}")
+
+                if session is None or current_time - previous_time > max_gap_seconds:
+                    if session is not None:
+                        written.append(session.close())
+                    session = SessionWriter(gps_prefix, current_time)
+                session.write(row, current_time)
+                previous_time = current_time
+        except BaseException:
+            if session is not None:
+                session.discard()
+            raise
+
+    if session is None:
+        print("No data rows found.")
+        return written
+    written.append(session.close())
+    return written
+
+def expand_inputs(patterns):
+    # Names as given, glob patterns expanded (for quoted patterns)
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            print(f"No files match {pattern}")
+        filenames.extend(matches)
+    return filenames
+
+def split_file(job):
+    filename, max_gap_seconds = job
+    try:
+        return split_csv_by_time_gap(filename, max_gap_seconds)
+    except (OSError, ValueError) as e:
+        print(f"Error processing {filename}: {e}")
+        return None
+
+def split_files(filenames, max_gap_seconds, jobs=1):
+    # One file per worker; returns the number of files that failed
+    work = [(filename, max_gap_seconds) for filename in filenames]
+    if jobs > 1 and len(work) > 1:
+        with multiprocessing.Pool(min(jobs, len(work))) as pool:
+            results = pool.map(split_file, work)
+    else:
+        results = [split_file(job) for job in work]
+    return sum(result is None for result in results)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python split_gps.py gps06_something.csv max_gap_seconds")
-        sys.exit(1)
-
-    filename = sys.argv[1]
-    max_gap_seconds = int(sys.argv[2])
-    split_csv_by_time_gap(filename, max_gap_seconds)
+    parser = argparse.ArgumentParser(description="Split GPS CSV exports into sessions at time gaps")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of files processed in parallel (default 1)')
+    parser.add_argument('files', nargs='+', help='CSV files or glob patterns')
+    parser.add_argument('max_gap_seconds', type=int)
+    args = parser.parse_args()
+    failed = split_files(expand_inputs(args.files), args.max_gap_seconds, args.jobs)
+    sys.exit(1 if failed else 0)
@@ -1,258 +1,555 @@
 #!/usr/bin/python3 
 
-import sqlite3
 import os
 import re
-from datetime import datetime, timedelta
+import html
+import sys
+import glob
+import time
+import argparse
+import tempfile
+import multiprocessing
+import gpsDb
+import gpsMetrics
+import gpsCompress
+import gpsLayout
+import gpsTiles
+import coSessions
+import gpsSegment
+from gpsTrack import Track, NO_VALUE
+from gpsTime import epoch_ms, utc_datetime
 
 # Configuration
 SQLITE_DB = 'gps_data.db'
+INPUT_DIR = os.path.expanduser('~/Downloads')  # where the files in gps_files are
 MAX_GAP_TIME = 60  # minutes (default 60 minutes)
 OUTPUT_DIR = os.path.expanduser('~/Downloads/processed')
+OUTPUT_FORMAT = 'csv'  # 'csv', 'bin' (gpsSegment .seg files) or 'both'
+OUTPUT_FORMATS = ('csv', 'bin', 'both')
+OUTPUT_COMPRESSION = None  # None, 'gzip' or 'lzma' for the segment CSVs (.seg files stay plain for mmap)
+PARSE_CACHE_DIR = os.path.expanduser('~/Downloads/cache')  # parsed tracks by md5_hash, None to disable
+OUTPUT_LAYOUT = 'flat'  # 'flat', or 'partitioned': <device>/<year>/<month>/ with a manifest (gpsLayout)
+PART_SUFFIX = '.part'  # segment files are written under this suffix and renamed when the file is done
+STALE_PART_AGE = 24 * 3600  # seconds after which a parse cache .part file is taken as left by a killed run
 
-def process_gpx_files():
+def process_gpx_files(jobs=1, output_format=None, compression=None, layout=None):
     # Create output directory if it doesn't exist
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+    remove_stale_cache_parts()
     
-    # Connect to the database
-    conn = sqlite3.connect(SQLITE_DB)
-    cursor = conn.cursor()
-    
-    # Create the segments table if it doesn't exist
-    cursor.execute('''CREATE TABLE IF NOT EXISTS gpx_segments (
-                      id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      gpx_id INTEGER,
-                      filename TEXT,
-                      start_time TEXT,
-                      end_time TEXT,
-                      record_count INTEGER,
-                      min_lat REAL,
-                      max_lat REAL,
-                      min_lon REAL,
-                      max_lon REAL,
-                      FOREIGN KEY(gpx_id) REFERENCES gps_files(id))''')
+    # Connect to the database (creates/migrates the tables). This process
+    # is the only writer, workers just parse, split and write the CSVs.
+    conn = gpsDb.get_connection(SQLITE_DB)
     
     # Get all files with processingState=0
-    cursor.execute("SELECT id, filename FROM gps_files WHERE processingState=0")
-    files_to_process = cursor.fetchall()
+    output_format = output_format or OUTPUT_FORMAT
+    compression = compression or OUTPUT_COMPRESSION
+    layout = layout or OUTPUT_LAYOUT
+    files_to_process = [(file_id, filename, md5_hash, output_format, compression, layout, MAX_GAP_TIME, INPUT_DIR)
+                        for file_id, filename, md5_hash in gpsDb.pending_files(conn)]
     
-    for file_id, filename in files_to_process:
-        try:
-            print(f"Processing {filename} (ID: {file_id})...")
-            full_path = os.path.join(os.path.expanduser('~/Downloads'), filename)
-            
-            if not os.path.exists(full_path):
-                print(f"File not found: {full_path}")
-                continue
-            
-            # Parse the GPX file
-            track_points = parse_gpx_file(full_path)
-            
-            if not track_points:
-                print("No track points found in file")
-                mark_as_processed(cursor, file_id, 1)  # Mark as processed
-                conn.commit()
-                continue
-            
-            # Split track points into segments based on time gaps
-            segments = split_track_points(track_points)
-            
-            # Process each segment
-            base_name = os.path.splitext(filename)[0]
-            for i, segment in enumerate(segments, start=1):
-                # Get the first and last times in the segment for filename
-                first_time_str = segment[0]['time']
-                last_time_str = segment[-1]['time']
-                
-                # Parse the times
-                first_time = parse_time(first_time_str)
-                last_time = parse_time(last_time_str)
-                
-                # Format date and time components for filename
-                date_time_suffix = ""
-                if first_time and last_time:
-                    month_day = first_time.strftime('%m%d')  # Two-digit month and day
-                    start_time = first_time.strftime('%H%M')  # Start time (HHMM)
-                    end_time = last_time.strftime('%H%M')     # End time (HHMM)
-                    date_time_suffix = f"_{month_day}_{start_time}-{end_time}"
-                elif first_time:
-                    month_day = first_time.strftime('%m%d')
-                    start_time = first_time.strftime('%H%M')
-                    date_time_suffix = f"_{month_day}_{start_time}-0000"
-                elif last_time:
-                    end_time = last_time.strftime('%H%M')
-                    date_time_suffix = "_0000_0000-{end_time}"
-                else:
-                    date_time_suffix = "_0000_0000-0000"
-                
-                output_filename = f"{base_name}{date_time_suffix}.{i:03d}.csv"
-                output_path = os.path.join(OUTPUT_DIR, output_filename)
-                
-                # Save segment to CSV and get stats
-                stats = save_to_csv(segment, output_path)
-                
-                # Insert segment info into database
-                cursor.execute('''INSERT INTO gpx_segments 
-                                (gpx_id, filename, start_time, end_time, record_count,
-                                 min_lat, max_lat, min_lon, max_lon)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                             (file_id, output_filename, stats['start_time'], 
-                              stats['end_time'], stats['count'],
-                              stats['min_lat'], stats['max_lat'],
-                              stats['min_lon'], stats['max_lon']))
-                
-                print(f"Saved segment {i} to {output_path} with {stats['count']} points")
-            
-            # Mark original file as processed
-            mark_as_processed(cursor, file_id, 1)
-            conn.commit()
-            print(f"Finished processing {filename}")
-            
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
-            # Mark as error state (2)
-            mark_as_processed(cursor, file_id, 2)
-            conn.commit()
+    with gpsMetrics.profiled('process_gpx_files'):
+        for file_id, state, segment_rows, tile_rows in run_files(files_to_process, jobs):
+            if state is None:
+                continue  # File not found, leave it for a later run
+            with gpsMetrics.timer('db'):
+                gpsDb.save_file_segments(conn, file_id, segment_rows, state, tile_rows)
+        with gpsMetrics.timer('groups'):
+            coSessions.update_groups(conn)
+
+def resegment_files(max_gap=None, jobs=1, output_format=None, compression=None, layout=None):
+    # Splits the processed files again whose segments were made with
+    # another gap threshold, from the parse cache where it has them
+    max_gap = MAX_GAP_TIME if max_gap is None else max_gap
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    remove_stale_cache_parts()
+    conn = gpsDb.get_connection(SQLITE_DB)
+    output_format = output_format or OUTPUT_FORMAT
+    compression = compression or OUTPUT_COMPRESSION
+    layout = layout or OUTPUT_LAYOUT
+    files_to_process = [(file_id, filename, md5_hash, output_format, compression, layout, max_gap, INPUT_DIR)
+                        for file_id, filename, md5_hash in gpsDb.files_to_resegment(conn, max_gap)]
     
-    conn.close()
+    count = 0
+    with gpsMetrics.profiled('resegment_files'):
+        for file_id, state, segment_rows, tile_rows in run_files(files_to_process, jobs):
+            if state != 1:
+                continue  # The old segments stay
+            with gpsMetrics.timer('db'):
+                old_filenames = gpsDb.replace_file_segments(conn, file_id, segment_rows, tile_rows)
+            remove_stale_segments(old_filenames, [row[1] for row in segment_rows],
+                                  output_format, compression)
+            count += 1
+        with gpsMetrics.timer('groups'):
+            coSessions.update_groups(conn)
+    print(f"Resegmented {count} of {len(files_to_process)} files with a {max_gap} minute gap")
 
-def parse_gpx_file(file_path):
-    track_points = []
-    in_trkpt = False
-    current_point = {}
+def run_files(files_to_process, jobs=1):
+    # Generator: process_file results in input order, from a process pool
+    # with jobs > 1
+    if jobs > 1 and len(files_to_process) > 1:
+        # imap keeps the input order, so rows are inserted exactly as in
+        # the serial path
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(process_file_with_metrics, files_to_process)
+    else:
+        pool = None
+        results = map(process_file_with_metrics, files_to_process)
     
-    with open(file_path, 'r') as f:
-        for line in f:
-            line = line.strip()
+    try:
+        for result, metrics in results:
+            gpsMetrics.merge(metrics)
+            yield result
+    except BaseException:
+        # Interrupted: the files not committed yet are simply pending
+        # again on the next run
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        gpsMetrics.write_snapshot()
+
+def remove_partial_segments(base_name):
+    # Segment files a killed run left unfinished for this source file, in
+    # either layout. Only names segment_filename makes for it, so the .part
+    # files of a sibling archive (<base>_2) being written meanwhile stay.
+    pattern = (glob.escape(os.path.basename(base_name)) + '_[0-9][0-9][0-9][0-9]_*.[0-9][0-9][0-9].*'
+               + PART_SUFFIX)
+    root = glob.escape(OUTPUT_DIR)
+    device = glob.escape(gpsLayout.device_name(base_name))
+    for path in glob.glob(os.path.join(root, pattern)) + glob.glob(os.path.join(root, device, '*', '*', pattern)):
+        os.remove(path)
+
+def remove_stale_segments(old_filenames, new_filenames, output_format=None, compression=None):
+    # Deletes the files of the old segments (all formats, compressed or
+    # not) that were not just written for the new ones
+    keep = {path for name in new_filenames
+            for path in segment_paths(os.path.join(OUTPUT_DIR, segment_base(name) + '.csv'),
+                                      output_format, compression)}
+    for name in old_filenames:
+        base = os.path.join(OUTPUT_DIR, segment_base(name))
+        for extension in ('.csv', gpsSegment.EXTENSION):
+            for path in gpsCompress.existing_variants(base + extension):
+                if path not in keep:
+                    os.remove(path)
+                    gpsLayout.record_removed(OUTPUT_DIR, os.path.relpath(path, OUTPUT_DIR))
+
+def segment_base(filename):
+    # 'x.001.csv.gz' -> 'x.001'
+    return os.path.splitext(gpsCompress.strip_extension(filename))[0]
+
+def process_file_with_metrics(file_row):
+    # process_file plus the metrics it collected, which have to travel
+    # back to the parent when it ran in a worker
+    result = process_file(file_row)
+    return result, gpsMetrics.drain()
+
+def process_file(file_row):
+    # Parses, splits and writes the segment CSVs of one gps_files row,
+    # given as (id, filename, md5_hash, output format, compression, layout,
+    # gap in minutes, directory the filename is relative to).
+    # Returns (file_id, state, segment rows, tile rows), state None if the
+    # file is missing. Runs in a worker process with --jobs, so no DB access here.
+    # The segment files appear under their names only once the whole file
+    # is done, so an interrupted run leaves nothing but .part files.
+    file_id, filename, md5_hash, output_format, compression, layout, max_gap, input_dir = file_row
+    segment_rows = []
+    written = []
+    saved = []  # (paths, stats) for the manifest
+    tiles = gpsTiles.TileCounter()
+    clock = gpsMetrics.StageClock()
+    try:
+        print(f"Processing {filename} (ID: {file_id})...")
+        full_path = os.path.join(input_dir, filename)
+        
+        if not os.path.exists(full_path):
+            print(f"File not found: {full_path}")
+            gpsMetrics.count('files_processed_total', state='missing')
+            return file_id, None, [], []
+        
+        # Parse the GPX file (or read the parse cache) and split it into
+        # segments based on time gaps while it is being read ('split'
+        # includes 'parse' until the end, the parse share is taken out below)
+        gpsMetrics.count('bytes_read_total', os.path.getsize(full_path))
+        segments = clock.timed_iter('split', split_track_points(
+            clock.timed_iter('parse', track_chunks(full_path, md5_hash)), max_gap))
+        
+        # Process each segment
+        base_name = os.path.splitext(gpsCompress.strip_extension(filename))[0]
+        remove_partial_segments(base_name)
+        i = 0
+        for i, segment in enumerate(segments, start=1):
+            csv_path = os.path.join(OUTPUT_DIR, segment_relpath(base_name, i, segment, layout))
+            os.makedirs(os.path.dirname(csv_path), exist_ok=True)
             
-            # Check for track point start
-            if line.startswith('<trkpt'):
-                in_trkpt = True
-                current_point = {}
-                
-                # Extract latitude and longitude
-                lat_match = re.search(r'lat="([^"]+)"', line)
-                lon_match = re.search(r'lon="([^"]+)"', line)
-                if lat_match and lon_match:
-                    current_point['lat'] = float(lat_match.group(1))
-                    current_point['lon'] = float(lon_match.group(1))
-                continue
+            # Save segment to CSV (and/or .seg) and get stats
+            paths = segment_paths(csv_path, output_format, compression)
+            written += paths
+            with clock.stage('write'):
+                stats = save_segment(segment, csv_path, output_format, PART_SUFFIX, compression)
+            saved.append((paths, stats))
+            with clock.stage('tiles'):
+                tiles.add(segment)
+            gpsMetrics.count('points_total', stats['count'])
+            gpsMetrics.count('segments_total')
             
-            if not in_trkpt:
-                continue
+            # Segment info for the database
+            output_path = paths[0]
+            output_filename = os.path.relpath(output_path, OUTPUT_DIR)
+            segment_rows.append(segment_row(file_id, output_filename, stats, max_gap))
             
-            # Extract other fields
-            if line.startswith('<ele>'):
-                current_point['ele'] = float(line.replace('<ele>', '').replace('</ele>', ''))
-            elif line.startswith('<time>'):
-                current_point['time'] = line.replace('<time>', '').replace('</time>', '')
-            elif line.startswith('<speed>'):
-                current_point['speed'] = float(line.replace('<speed>', '').replace('</speed>', ''))
-            elif line.startswith('<name>'):
-                current_point['name'] = line.replace('<name>', '').replace('</name>', '')
-            elif line.startswith('</trkpt>'):
-                # End of track point
-                if 'lat' in current_point and 'lon' in current_point and 'time' in current_point:
-                    track_points.append(current_point)
-                in_trkpt = False
-    
-    return track_points
+            print(f"Saved segment {i} to {output_path} with {stats['count']} points")
+        
+        if i == 0:
+            print("No track points found in file")
+        
+        # Everything written, move the files into place (the same names
+        # again if the file was done before)
+        for path in written:
+            os.replace(path + PART_SUFFIX, path)
+        if layout == 'partitioned':
+            for paths, stats in saved:
+                for path in paths:
+                    record_segment(path, filename, stats)
+        
+        # Mark original file as processed
+        print(f"Finished processing {filename}")
+        gpsMetrics.count('files_processed_total', state='ok')
+        gpsMetrics.log_event('file_processed', file=filename, segments=len(segment_rows),
+                             points=sum(row[4] for row in segment_rows))
+        return file_id, 1, segment_rows, tiles.rows(gpsLayout.device_name(filename))
+        
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
+        for path in written:
+            if os.path.exists(path + PART_SUFFIX):
+                os.remove(path + PART_SUFFIX)
+        gpsMetrics.count('files_processed_total', state='error')
+        gpsMetrics.log_event('file_failed', file=filename, error=str(e))
+        # Mark as error state (2)
+        return file_id, 2, [], []
+    finally:
+        if 'split' in clock.totals:
+            clock.totals['split'] -= clock.totals.get('parse', 0.0)
+        clock.flush()
 
-def parse_time(time_str):
-    try:
-        return datetime.strptime(time_str, "%Y-%m-%dT%H:%M:%SZ")
-    except ValueError:
+READ_CHUNK_SIZE = 1024 * 1024  # bytes read from the GPX file at a time
+
+# One match per <trkpt> block. The fields come out directly when they are
+# in gpsbabel's order, anything else ends up in the last group and is
+# picked up by TRKPT_FIELD.
+TRKPT_BLOCK = re.compile(rb'<trkpt\b([^>]*)>\s*(?:<ele>([^<]*)</ele>\s*)?'
+                         rb'(?:<time>([^<]*)</time>\s*)?(?:<speed>([^<]*)</speed>\s*)?'
+                         rb'(?:<name>([^<]*)</name>\s*)?(.*?)</trkpt>', re.S)
+TRKPT_LATLON = re.compile(rb'\s+lat="([^"]*)"\s+lon="([^"]*)"\s*')
+TRKPT_ATTR = re.compile(rb'\b(lat|lon)="([^"]*)"')
+TRKPT_FIELD = re.compile(rb'<(ele|time|speed|name)>([^<]*)</')
+
+class GpxPointReader:
+    # Incremental GPX tokenizer. Raw bytes go in through feed() in chunks of
+    # any size, the finished track points come out as a Track. Only the unfinished tail
+    # after the last </trkpt> is kept between calls, and the element layout
+    # (one per line or several on one line) does not matter.
+    def __init__(self):
+        self.pending = b''
+
+    def feed(self, data):
+        buf = self.pending + data if self.pending else data
+        cut = buf.rfind(b'</trkpt>')
+        if cut < 0:
+            start = buf.rfind(b'<trkpt')
+            self.pending = buf[start:] if start >= 0 else buf[-5:]
+            return Track()
+        cut += 8
+        self.pending = buf[cut:]
+        return decode_trkpts(buf, cut)
+
+def decode_trkpts(buf, end):
+    track = Track()
+    # Bound appends, this loop runs once per point
+    add_time, add_times = track.time.append, track.times.append
+    add_lat, add_lon = track.lat.append, track.lon.append
+    add_ele, add_speed, add_name = track.ele.append, track.speed.append, track.name.append
+    intern = sys.intern
+    for attrs, ele, time, speed, name, rest in TRKPT_BLOCK.findall(buf, 0, end):
+        match = TRKPT_LATLON.fullmatch(attrs)
+        if match:
+            lat, lon = match.groups()
+        else:
+            found = dict(TRKPT_ATTR.findall(attrs))
+            lat, lon = found.get(b'lat'), found.get(b'lon')
+        if rest:
+            # Elements out of gpsbabel's order or mixed with others
+            found = dict(TRKPT_FIELD.findall(rest))
+            ele = ele or found.get(b'ele')
+            time = time or found.get(b'time')
+            speed = speed or found.get(b'speed')
+            name = name or found.get(b'name')
+        if not lat or not lon or not time:
+            continue
+        time = time.decode('ascii')
+        epoch = epoch_ms(time)
+        if epoch is None:
+            continue  # Skip points with unreadable timestamps
+        
+        add_time(epoch)
+        add_times(time)
+        add_lat(float(lat))
+        add_lon(float(lon))
+        add_ele(float(ele) if ele else NO_VALUE)
+        add_speed(float(speed) if speed else NO_VALUE)
+        if name:
+            name = name.decode('utf-8')
+            if '&' in name:
+                name = html.unescape(name)
+        add_name(intern(name) if name else '')
+    return track
+
+def parse_cache_path(md5_hash):
+    if not PARSE_CACHE_DIR or not md5_hash:
+        return None
+    return os.path.join(PARSE_CACHE_DIR, md5_hash + gpsSegment.EXTENSION)
+
+def remove_stale_cache_parts(max_age=STALE_PART_AGE):
+    # Temporary parse cache files of killed runs; the ones still being
+    # written by another process are younger than max_age
+    if not PARSE_CACHE_DIR:
+        return
+    cutoff = time.time() - max_age
+    for path in glob.glob(os.path.join(glob.escape(PARSE_CACHE_DIR), '*' + PART_SUFFIX)):
         try:
-            return datetime.strptime(time_str, "%Y-%m-%dT%H:%M:%S.%fZ")
-        except ValueError:
-            return None
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+class ParseCacheWriter:
+    # Collects the parsed Track chunks of a file in a temporary file, one
+    # gpsSegment block per chunk; commit() files it under the md5_hash.
+    # The temporary name is unique, so a monitor worker and a splitFiles.py
+    # run on the same file don't write into each other's.
+    def __init__(self):
+        self.file = None
+        if PARSE_CACHE_DIR:
+            os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+            fd, self.tmp_path = tempfile.mkstemp(suffix=PART_SUFFIX, dir=PARSE_CACHE_DIR)
+            self.file = os.fdopen(fd, 'wb')
+
+    def add(self, chunk):
+        if self.file and len(chunk):
+            gpsSegment.write_block(self.file, chunk)
+
+    def commit(self, md5_hash):
+        if self.file:
+            self.file.close()
+            self.file = None
+            os.replace(self.tmp_path, parse_cache_path(md5_hash))
+
+    def discard(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            os.remove(self.tmp_path)
+
+def track_chunks(file_path, md5_hash=None):
+    # Generator of Track chunks, from the parse cache if it has the file,
+    # otherwise parsed from the GPX and added to the cache. Caches older
+    # than gpsSegment version 2 lack the time strings and are made again.
+    cache_path = parse_cache_path(md5_hash)
+    if cache_path and os.path.exists(cache_path) and gpsSegment.file_version(cache_path) == gpsSegment.VERSION:
+        yield from gpsSegment.read_tracks(cache_path)
+        return
+    cache = ParseCacheWriter() if cache_path else None
+    try:
+        for chunk in parse_gpx_file(file_path):
+            if cache:
+                cache.add(chunk)
+            yield chunk
+        if cache:
+            cache.commit(md5_hash)
+    finally:
+        if cache:
+            cache.discard()
 
-def split_track_points(track_points):
-    if not track_points:
-        return []
+def parse_gpx_file(file_path):
+    # Generator: yields one Track chunk per read while the file is being
+    # read (and decompressed), the whole file is never held in memory
+    reader = GpxPointReader()
+    with gpsCompress.open_file(file_path) as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            yield reader.feed(chunk)
+
+def segment_relpath(base_name, i, segment, layout=None):
+    # Segment .csv path relative to OUTPUT_DIR: the plain name, or under
+    # the device/year/month partition of the segment's first point
+    name = segment_filename(os.path.basename(base_name), i, segment)
+    if (layout or OUTPUT_LAYOUT) == 'partitioned':
+        return os.path.join(gpsLayout.partition(gpsLayout.device_name(base_name), segment.time[0]), name)
+    return name
+
+def record_segment(path, source, stats):
+    # Manifest entry of a finished segment file
+    gpsLayout.record(OUTPUT_DIR, os.path.relpath(path, OUTPUT_DIR), kind='segment', source=source,
+                     start=stats['start_time'], end=stats['end_time'], points=stats['count'])
+
+def segment_filename(base_name, i, segment):
+    # Get the first and last times in the segment for filename
+    first_time_str = segment.times[0]
+    last_time_str = segment.times[-1]
     
-    segments = []
-    current_segment = []
-    prev_time = None
+    # Parse the times
+    first_time = parse_time(first_time_str)
+    last_time = parse_time(last_time_str)
     
-    for point in track_points:
-        if not point.get('time'):
-            continue  # Skip points without timestamps
+    # Format date and time components for filename
+    date_time_suffix = ""
+    if first_time and last_time:
+        month_day = first_time.strftime('%m%d')  # Two-digit month and day
+        start_time = first_time.strftime('%H%M')  # Start time (HHMM)
+        end_time = last_time.strftime('%H%M')     # End time (HHMM)
+        date_time_suffix = f"_{month_day}_{start_time}-{end_time}"
+    elif first_time:
+        month_day = first_time.strftime('%m%d')
+        start_time = first_time.strftime('%H%M')
+        date_time_suffix = f"_{month_day}_{start_time}-0000"
+    elif last_time:
+        end_time = last_time.strftime('%H%M')
+        date_time_suffix = "_0000_0000-{end_time}"
+    else:
+        date_time_suffix = "_0000_0000-0000"
+    
+    return f"{base_name}{date_time_suffix}.{i:03d}.csv"
+
+def segment_row(file_id, output_filename, stats, max_gap=None):
+    return (file_id, output_filename, stats['start_time'],
+            stats['end_time'], stats['count'],
+            stats['min_lat'], stats['max_lat'],
+            stats['min_lon'], stats['max_lon'],
+            MAX_GAP_TIME if max_gap is None else max_gap,
+            stats['distance'], stats['moving_time'], stats['max_speed'],
+            stats['avg_speed'], stats['elevation_gain'])
+
+def parse_time(time_str):
+    ms = epoch_ms(time_str)
+    return utc_datetime(ms) if ms is not None else None
+
+class SegmentSplitter:
+    # Push version of the gap splitter: push() Track chunks in time order
+    # and get back the segments closed by a gap. Segments that fit inside
+    # one chunk are zero-copy views, only a segment spanning chunks is
+    # copied.
+    def __init__(self, max_gap=None):
+        self.max_gap_ms = (MAX_GAP_TIME if max_gap is None else max_gap) * 60 * 1000
+        self.current_segment = Track()
+        self.prev_time = None
+
+    def push(self, chunk):
+        finished = []
+        if not len(chunk):
+            return finished
         
-        current_time = parse_time(point['time'])
-        if not current_time:
-            continue
+        cuts = chunk.gap_indices(self.max_gap_ms)
+        if self.prev_time is not None and chunk.time[0] - self.prev_time > self.max_gap_ms:
+            cuts.insert(0, 0)
         
-        if prev_time is None:
-            # First point in segment
-            current_segment.append(point)
-        else:
-            time_diff = (current_time - prev_time).total_seconds() / 60  # in minutes
-            
-            if time_diff > MAX_GAP_TIME:
-                # Time gap exceeds threshold, start new segment
-                if current_segment:
-                    segments.append(current_segment)
-                current_segment = [point]
-            else:
-                # Continue current segment
-                current_segment.append(point)
+        start = 0
+        for cut in cuts:
+            # Time gap exceeds threshold, close the segment before the cut
+            if len(self.current_segment):
+                self.current_segment.extend(chunk.view(start, cut))
+                finished.append(self.current_segment)
+                self.current_segment = Track()
+            elif cut > start:
+                finished.append(chunk.view(start, cut))
+            start = cut
         
-        prev_time = current_time
-    
-    # Add the last segment
-    if current_segment:
-        segments.append(current_segment)
-    
-    return segments
-
-def save_to_csv(segment, output_path):
-    stats = {
-        'count': 0,
-        'start_time': None,
-        'end_time': None,
-        'min_lat': None,
-        'max_lat': None,
-        'min_lon': None,
-        'max_lon': None
-    }
-    
-    with open(output_path, 'w') as f:
+        self.current_segment.extend(chunk.view(start, len(chunk)))
+        self.prev_time = chunk.time[-1]
+        return finished
+
+    def finish(self):
+        # The last segment
+        last, self.current_segment = self.current_segment, Track()
+        return [last] if len(last) else []
+
+def split_track_points(chunks, max_gap=None):
+    # Generator: yields each segment as soon as the gap after it is seen,
+    # so only the segment being built is kept in memory
+    splitter = SegmentSplitter(max_gap)
+    for chunk in chunks:
+        yield from splitter.push(chunk)
+    yield from splitter.finish()
+
+def save_to_csv(segment, output_path, compression=None):
+    with gpsCompress.open_file(output_path, 'wt', compression) as f:
         # Write header
         f.write("latitude,longitude,elevation,timestamp,speed,name\n")
         
-        # Write data points and collect stats
-        for i, point in enumerate(segment):
-            line = [
-                str(point.get('lat', '')),
-                str(point.get('lon', '')),
-                str(point.get('ele', '')),
-                point.get('time', ''),
-                str(point.get('speed', '')),
-                f'"{point.get("name", "")}"'  # Quote names in case they contain commas
-            ]
-            f.write(','.join(line) + '\n')
-            
-            # Update stats
-            if i == 0:
-                stats['start_time'] = point['time']
-                stats['min_lat'] = point['lat']
-                stats['max_lat'] = point['lat']
-                stats['min_lon'] = point['lon']
-                stats['max_lon'] = point['lon']
-            else:
-                stats['min_lat'] = min(stats['min_lat'], point['lat'])
-                stats['max_lat'] = max(stats['max_lat'], point['lat'])
-                stats['min_lon'] = min(stats['min_lon'], point['lon'])
-                stats['max_lon'] = max(stats['max_lon'], point['lon'])
-            
-            stats['end_time'] = point['time']
-            stats['count'] += 1
+        # Write data points, missing ele/speed (NaN) are written empty
+        rows = zip(segment.lat, segment.lon, segment.ele, segment.times,
+                   segment.speed, segment.name)
+        f.writelines(f'{lat},{lon},{ele if ele == ele else ""},{time},'
+                     f'{speed if speed == speed else ""},"{name}"\n'
+                     for lat, lon, ele, time, speed, name in rows)
     
-    return stats
+    # Stats come from whole-column reductions
+    return segment.stats()
+
+def segment_paths(output_path, output_format=None, compression=None):
+    # Files written for a segment, output_path being its .csv path. The
+    # first one is the name recorded in gpx_segments.
+    output_format = output_format or OUTPUT_FORMAT
+    compression = compression or OUTPUT_COMPRESSION
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    paths = []
+    if output_format in ('csv', 'both'):
+        paths.append(gpsCompress.add_extension(output_path, compression))
+    if output_format in ('bin', 'both'):
+        paths.append(os.path.splitext(output_path)[0] + gpsSegment.EXTENSION)
+    return paths
 
-def mark_as_processed(cursor, file_id, state):
-    cursor.execute("UPDATE gps_files SET processingState=? WHERE id=?", (state, file_id))
+def save_segment(segment, output_path, output_format=None, suffix='', compression=None):
+    # Writes the segment in the configured format(s), each file name
+    # followed by suffix
+    for path in segment_paths(output_path, output_format, compression):
+        if path.endswith(gpsSegment.EXTENSION):
+            stats = gpsSegment.save_segment(segment, path + suffix)
+        else:
+            stats = save_to_csv(segment, path + suffix, gpsCompress.compression_of(path))
+    return stats
 
 if __name__ == "__main__":
-    process_gpx_files()
+    parser = argparse.ArgumentParser(description='Split pending GPX files into segments')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of files parsed in parallel (default 1)')
+    parser.add_argument('--max-gap', type=int,
+                        help=f'gap in minutes that starts a new segment (default {MAX_GAP_TIME})')
+    parser.add_argument('--resegment', action='store_true',
+                        help='split processed files made with another gap again, from the parse cache')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default=OUTPUT_FORMAT,
+                        help=f'segment file format (default {OUTPUT_FORMAT})')
+    parser.add_argument('--compression', choices=('none', 'gzip', 'lzma'),
+                        default=OUTPUT_COMPRESSION or 'none',
+                        help=f'compression of the segment CSVs (default {OUTPUT_COMPRESSION or "none"})')
+    parser.add_argument('--layout', choices=gpsLayout.LAYOUTS, default=OUTPUT_LAYOUT,
+                        help=f'segment directory layout (default {OUTPUT_LAYOUT})')
+    parser.add_argument('--metrics-textfile', help='write metrics in Prometheus textfile format')
+    parser.add_argument('--metrics-json', help='write a JSON metrics snapshot')
+    parser.add_argument('--event-log', help='append JSON-lines events to this file')
+    parser.add_argument('--profile', metavar='DIR', help='write a cProfile dump of the run to DIR')
+    args = parser.parse_args()
+    gpsMetrics.TEXTFILE = args.metrics_textfile
+    gpsMetrics.JSON_FILE = args.metrics_json
+    gpsMetrics.EVENT_LOG = args.event_log
+    gpsMetrics.PROFILE_DIR = args.profile
+    if args.max_gap is not None:
+        MAX_GAP_TIME = args.max_gap
+    OUTPUT_COMPRESSION = None if args.compression == 'none' else args.compression
+    if args.resegment:
+        resegment_files(MAX_GAP_TIME, args.jobs, args.format, OUTPUT_COMPRESSION, args.layout)
+    else:
+        process_gpx_files(args.jobs, args.format, OUTPUT_COMPRESSION, args.layout)